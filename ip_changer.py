@@ -1,8 +1,145 @@
 
 import time
+import threading
+import ipaddress
+import statistics
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import requests
-from stem import Signal
-from stem.control import Controller
+from requests.adapters import HTTPAdapter
+import stem
+from stem import CircBuildFlag, CircPurpose, CircStatus, Signal
+from stem.control import Controller, EventType
+
+# Shared session so repeated IP checks reuse one connection through Tor
+_tor_session = None
+
+# Last exit IP seen through Tor; reused for IP_CACHE_TTL seconds and dropped on NEWNYM
+IP_CACHE_TTL = 30
+_ip_cache = {'ip': None, 'checked_at': 0.0}
+_ip_lock = threading.Lock()
+
+# Plain-text IP echo services. Each check starts on the next one in turn; if it hasn't
+# answered within the median of recent checks, the next service is asked as well and
+# the first answer wins.
+IP_CHECK_URLS = [
+    "http://icanhazip.com",
+    "http://api.ipify.org",
+    "http://checkip.amazonaws.com",
+]
+_ip_check_turn = 0
+_ip_check_latencies = deque(maxlen=20)
+_ip_check_pool = ThreadPoolExecutor(max_workers=2)
+
+def get_tor_session():
+    """
+    Returns a pooled requests.Session routed through the Tor SOCKS5 proxy.
+    Connections stay open between calls, so checking the IP again on the same
+    circuit doesn't pay for a new SOCKS handshake and DNS lookup every time.
+    """
+    global _tor_session
+    if _tor_session is None:
+        _tor_session = requests.Session()
+        # Ignore HTTP_PROXY/HTTPS_PROXY from the environment; we always go through Tor.
+        _tor_session.trust_env = False
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        _tor_session.mount('http://', adapter)
+        _tor_session.mount('https://', adapter)
+        # Define proxies for HTTP and HTTPS traffic through Tor.
+        _tor_session.proxies = {
+            'http': 'socks5h://127.0.0.1:9050',
+            'https': 'socks5h://127.0.0.1:9050'
+        }
+    return _tor_session
+
+def reset_tor_session():
+    """
+    Closes the pooled connections of the shared Tor session.
+    Streams opened before NEWNYM keep using their old circuit, so a reused
+    connection would keep reporting the old exit IP.
+    """
+    if _tor_session is not None:
+        _tor_session.close()
+    with _ip_lock:
+        _ip_cache['ip'] = None
+
+class TorController:
+    """
+    Long-lived, auto-reconnecting session with the Tor control port.
+    Authenticating once and keeping the connection open avoids a new control
+    connection per rotation. Listening for CIRC events lets us wait until Tor has
+    actually built a fresh circuit after NEWNYM instead of checking the IP too early.
+    """
+    def __init__(self, port=9051):
+        self.port = port
+        self.controller = None
+        self.lock = threading.Lock()
+        self.circuit_built = threading.Event()
+
+    def connect(self):
+        """Returns an authenticated controller, reconnecting if Tor dropped the old one."""
+        if self.controller is not None and self.controller.is_alive():
+            return self.controller
+        self.close()
+        controller = Controller.from_port(port=self.port)
+        # No password needed if CookieAuthentication is enabled.
+        controller.authenticate()
+        controller.add_event_listener(self._on_circuit_event, EventType.CIRC)
+        self.controller = controller
+        return controller
+
+    def _on_circuit_event(self, event):
+        # Only general-purpose exit circuits matter; internal ones (directory
+        # fetches, onion services) never carry our traffic.
+        if (event.status == CircStatus.BUILT and event.purpose == CircPurpose.GENERAL
+                and CircBuildFlag.IS_INTERNAL not in (event.build_flags or ())):
+            self.circuit_built.set()
+
+    def newnym_wait(self):
+        """Seconds until Tor will accept another NEWNYM (0 if it would now)."""
+        controller = self.connect()
+        return 0 if controller.is_newnym_available() else controller.get_newnym_wait()
+
+    def new_identity(self, timeout=60):
+        """
+        Sends NEWNYM, first waiting out Tor's rate limit, and then waits for a
+        new exit circuit to be built.
+        Returns True if a fresh circuit was seen within `timeout` seconds.
+        """
+        with self.lock:
+            for attempt in (0, 1):
+                try:
+                    wait = self.newnym_wait()
+                    if wait > 0:
+                        # Tor silently ignores NEWNYM inside this window, so the exit would not change
+                        print(f"Tor is rate-limiting new identities; waiting {wait:.1f}s...")
+                        time.sleep(wait)
+                    self.circuit_built.clear()
+                    self.controller.signal(Signal.NEWNYM)
+                    break
+                except stem.SocketError:
+                    # The control connection died (e.g. Tor restarted); reconnect once
+                    self.close()
+                    if attempt:
+                        raise
+            built = self.circuit_built.wait(timeout)
+        # Drop kept-alive connections so the next check opens a stream on the new circuit.
+        reset_tor_session()
+        return built
+
+    def close(self):
+        if self.controller is not None:
+            self.controller.close()
+            self.controller = None
+
+_tor_controller = None
+
+def get_tor_controller():
+    """Returns the shared TorController, creating it on first use."""
+    global _tor_controller
+    if _tor_controller is None:
+        _tor_controller = TorController()
+    return _tor_controller
 
 # Function to renew the Tor circuit, effectively changing the IP address
 def renew_tor_connection():
@@ -10,36 +147,68 @@ def renew_tor_connection():
     Renews the Tor circuit by sending a NEWNYM signal to the Tor controller.
     This action requests a new identity, which typically results in a new exit node
     and thus a new public IP address.
+    Returns True once Tor has built a new circuit, False otherwise.
     """
     try:
-        with Controller.from_port(port=9051) as controller:
-            # Authenticate with the Tor controller. No password needed if CookieAuthentication is enabled.
-            controller.authenticate()
-            # Send the NEWNYM signal to request a new Tor circuit.
-            controller.signal(Signal.NEWNYM)
-        print("Tor connection renewed. New IP address should be active.")
+        if get_tor_controller().new_identity():
+            print("Tor connection renewed. New circuit is built.")
+            return True
+        print("NEWNYM sent, but no new circuit was built in time.")
     except Exception as e:
         print(f"Error renewing Tor connection: {e}")
+    return False
 
 # Function to get the current public IP address using httpbin.org
-def get_current_ip():
+def get_current_ip(max_age=IP_CACHE_TTL):
     """
     Fetches the current public IP address by making a request through the Tor SOCKS5 proxy.
+    A result younger than max_age seconds is returned without a new request; the lock
+    is held during the fetch so concurrent callers share one lookup.
     Returns the IP address as a string if successful, otherwise returns None.
     """
-    try:
-        # Define proxies for HTTP and HTTPS traffic through Tor.
-        proxies = {
-            'http': 'socks5h://127.0.0.1:9050',
-            'https': 'socks5h://127.0.0.1:9050'
-        }
-        # Make a GET request to httpbin.org/ip through the Tor proxy.
-        response = requests.get("http://httpbin.org/ip", proxies=proxies, timeout=10)
-        # Parse the JSON response and extract the 'origin' field, which contains the IP.
-        return response.json().get("origin")
-    except requests.exceptions.RequestException as e:
-        print(f"Error getting IP: {e}")
-        return None
+    with _ip_lock:
+        if _ip_cache['ip'] and time.time() - _ip_cache['checked_at'] < max_age:
+            return _ip_cache['ip']
+        try:
+            ip = _hedged_ip_check()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Error getting IP: {e}")
+            return None
+        _ip_cache.update(ip=ip, checked_at=time.time())
+        return ip
+
+def _ask_ip(url):
+    """Asks one echo service through Tor, returning the reported address."""
+    response = get_tor_session().get(url, timeout=10)
+    response.raise_for_status()
+    # ip_address raises ValueError on an error page instead of an address
+    return str(ipaddress.ip_address(response.text.strip()))
+
+def _hedged_ip_check():
+    """
+    Asks the next echo service for our IP, hedging onto a second service when the
+    first is slower than the median of recent checks. Raises the last error if every
+    attempt failed.
+    """
+    global _ip_check_turn
+    urls = [IP_CHECK_URLS[(_ip_check_turn + i) % len(IP_CHECK_URLS)] for i in range(2)]
+    _ip_check_turn = (_ip_check_turn + 1) % len(IP_CHECK_URLS)
+    delay = statistics.median(_ip_check_latencies) if len(_ip_check_latencies) >= 5 else 2.0
+    delay = min(5.0, max(0.5, delay))
+    pending = {_ip_check_pool.submit(_ask_ip, urls.pop(0)): time.monotonic()}
+    error = None
+    while pending:
+        done, _ = wait(pending, timeout=delay if urls else None, return_when=FIRST_COMPLETED)
+        for future in done:
+            started = pending.pop(future)
+            if future.exception() is None:
+                _ip_check_latencies.append(time.monotonic() - started)
+                return future.result()
+            error = future.exception()
+        # Either the first service is slow or it failed: ask the next one
+        if urls:
+            pending[_ip_check_pool.submit(_ask_ip, urls.pop(0))] = time.monotonic()
+    raise error
 
 # Main function to run the IP changing script
 def main():
@@ -80,14 +249,21 @@ def main():
         print("Script will run indefinitely.")
 
     # Main loop for IP rotation
+    previous_ip = get_current_ip()
     while time.time() < end_time:
         print(f"\n[{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())}] Requesting new IP...")
-        renew_tor_connection()
+        renewed = renew_tor_connection()
         current_ip = get_current_ip()
-        if current_ip:
+        if not current_ip:
+            print("Could not verify new IP address.")
+        elif current_ip == previous_ip:
+            # A new circuit can still exit through the same relay
+            print(f"IP unchanged: {current_ip}")
+        elif renewed:
             print(f"New IP address: {current_ip}")
         else:
-            print("Could not verify new IP address.")
+            print(f"IP address: {current_ip} (new circuit not confirmed)")
+        previous_ip = current_ip or previous_ip
 
         # Calculate remaining time for the current interval to ensure accurate waiting
         time_to_wait = interval - ((time.time() - start_time) % interval)
@@ -100,6 +276,7 @@ def main():
         print(f"Waiting for {interval} seconds before next IP change...")
         time.sleep(interval)
 
+    get_tor_controller().close()
     print("\nScript finished running.")
 
 # Entry point of the script
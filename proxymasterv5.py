@@ -18,30 +18,2661 @@ import socket
 import struct
 import uuid
 import sqlite3
+import asyncio
+import errno
+import ipaddress
+import argparse
+import heapq
+import bisect
+import queue
+import tempfile
+import statistics
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping, Sequence
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from urllib.parse import parse_qsl, urlencode
+from requests.adapters import HTTPAdapter
 
 # ===== CONFIGURATION =====
 PROXY_API_URL = "https://proxylist.geonode.com/api/proxy-list?limit=500&page=1&sort_by=lastChecked&sort_type=desc"
 TOR_BRIDGES_URL = "https://bridges.torproject.org/bridges?transport=obfs4"
 LOG_FILE = "termux_proxy.log"
 ROTATION_INTERVAL = 300  # 5 minutes default
-IP_CHECK_URL = "http://icanhazip.com"
+# Plain-text IP echo services; checks rotate across them and hedge onto the next
+IP_CHECK_URLS = (
+    "http://icanhazip.com",
+    "http://api.ipify.org",
+    "http://checkip.amazonaws.com",
+    "http://ifconfig.me/ip",
+)
 CONFIG_FILE = "proxy_config.json"
 LOCAL_PROXY_HOST = "127.0.0.1"
 LOCAL_PROXY_PORT = 8080  # Fixed local proxy port
 VERSION = "5.0"
 DNSCRYPT_CONFIG = "/data/data/com.termux/files/usr/etc/dnscrypt-proxy/dnscrypt-proxy.toml"
+HEALTH_DB = "proxy_cache/proxy_health.db"
+CONTROL_SOCKET = "proxy_cache/control.sock"
+
+# ===== PROXY POOL =====
+class ProxyRecord(MutableMapping):
+    """One pool entry kept in slots rather than a dict, used exactly like the dict
+
+    record['latency'], .get, .pop, `in` and {**record} all behave as before. Every
+    slot starts as None and None means "missing", so hot loops can read
+    record.latency directly without an AttributeError per unset field; storing
+    None therefore removes the key. IPv4 hosts are stored as 4 packed bytes, ports as
+    ints, and country/city/protocol strings are interned so a large pool shares
+    one copy of "US" or "socks5". Keys outside FIELDS go to a dict made on first use.
+    """
+    FIELDS = ('host', 'port', 'protocol', 'country', 'city', 'latency', 'last_checked',
+              'is_favorite', 'ip', 'successes', 'failures', 'tested_at', 'used_at',
+              'fail_streak', 'open_until', 'probe_at')
+    __slots__ = FIELDS + ('_extra',)
+    SLOTS = frozenset(FIELDS)
+    INTERNED = frozenset(('protocol', 'country', 'city'))
+
+    def __init__(self, fields=(), **kwargs):
+        for field in self.__slots__:
+            setattr(self, field, None)
+        for key, value in dict(fields, **kwargs).items():
+            self[key] = value
+
+    @classmethod
+    def coerce(cls, proxy):
+        return proxy if isinstance(proxy, cls) else cls(proxy)
+
+    def __getitem__(self, key):
+        if key in self.SLOTS:
+            value = getattr(self, key)
+            if value is None:
+                raise KeyError(key)
+            if key == 'host' and value.__class__ is bytes:
+                return socket.inet_ntoa(value)
+            return value
+        if self._extra is None or key not in self._extra:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def get(self, key, default=None):
+        if key in self.SLOTS and key != 'host':
+            value = getattr(self, key)
+            return default if value is None else value
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        if key in self.SLOTS:
+            return getattr(self, key) is not None
+        return self._extra is not None and key in self._extra
+
+    def __setitem__(self, key, value):
+        if key in self.SLOTS:
+            if value is None:
+                pass
+            elif key == 'host':
+                try:
+                    value = socket.inet_pton(socket.AF_INET, value)
+                except (OSError, TypeError):
+                    pass
+            elif key == 'port':
+                value = int(value)
+            elif key in self.INTERNED and value.__class__ is str:
+                value = sys.intern(value)
+            setattr(self, key, value)
+            return
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.SLOTS:
+            if getattr(self, key) is None:
+                raise KeyError(key)
+            setattr(self, key, None)
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        for field in self.FIELDS:
+            if getattr(self, field) is not None:
+                yield field
+        if self._extra:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"ProxyRecord({dict(self)!r})"
+
+class ProxyPool(Sequence):
+    """Proxy records keyed by (host, port, protocol) that still read like the old list
+
+    Secondary indexes map country, city, protocol and latency bucket to the keys
+    holding that value, kept in step on insert, merge and removal, so location or
+    protocol lookups touch only the matching entries.
+    """
+    # Fields a fresh fetch may overwrite; everything else (exit IP, health) is ours
+    SOURCE_FIELDS = ('country', 'city', 'last_checked', 'is_favorite')
+    INDEXED = ('country', 'city', 'protocol')
+    # Upper bounds in ms; anything slower lands in the last bucket
+    LATENCY_BUCKETS = (100, 250, 500, 1000, 2000, 5000)
+
+    def __init__(self, proxies=()):
+        self.lock = threading.RLock()
+        self.items = []
+        self.positions = {}
+        self.indexes = {field: {} for field in self.INDEXED}
+        self.latency_index = [set() for _ in range(len(self.LATENCY_BUCKETS) + 1)]
+        self.merge(proxies)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+    def __iter__(self):
+        # Iterate a snapshot so a background merge can't break the loop
+        return iter(list(self.items))
+
+    def __contains__(self, proxy):
+        return proxy_key(proxy) in self.positions
+
+    def get(self, key):
+        position = self.positions.get(key)
+        return None if position is None else self.items[position]
+
+    def merge(self, proxies):
+        """Insert new proxies and refresh known ones in place; returns (added, updated)"""
+        added = updated = 0
+        with self.lock:
+            for proxy in proxies:
+                key = proxy_key(proxy)
+                position = self.positions.get(key)
+                if position is None:
+                    record = ProxyRecord.coerce(proxy)
+                    self.positions[key] = len(self.items)
+                    self.items.append(record)
+                    self._index(key, record)
+                    added += 1
+                    continue
+                existing = self.items[position]
+                self._unindex(key, existing)
+                for field in self.SOURCE_FIELDS:
+                    if field in proxy:
+                        existing[field] = proxy[field]
+                # API latency only stands in until we have measured the proxy ourselves
+                if 'latency' in proxy and not existing.get('ip'):
+                    existing['latency'] = proxy['latency']
+                self._index(key, existing)
+                updated += 1
+        return added, updated
+
+    def latency_bucket(self, latency):
+        return bisect.bisect_left(self.LATENCY_BUCKETS, latency if latency is not None else 5000)
+
+    def _index(self, key, proxy):
+        for field, index in self.indexes.items():
+            value = proxy.get(field)
+            if value:
+                index.setdefault(value, set()).add(key)
+        self.latency_index[self.latency_bucket(proxy.get('latency'))].add(key)
+
+    def _unindex(self, key, proxy):
+        for field, index in self.indexes.items():
+            keys = index.get(proxy.get(field))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[proxy.get(field)]
+        # The record may have been re-measured since it was indexed, so check every bucket
+        for keys in self.latency_index:
+            keys.discard(key)
+
+    def reindex(self, proxy):
+        """Move a proxy to its latency bucket after its latency changed in place"""
+        key = proxy_key(proxy)
+        with self.lock:
+            if key not in self.positions:
+                return
+            for keys in self.latency_index:
+                keys.discard(key)
+            self.latency_index[self.latency_bucket(proxy.get('latency'))].add(key)
+
+    def select(self, country=None, city=None, protocol=None, max_latency=None):
+        """Records matching every given criterion, found through the indexes"""
+        with self.lock:
+            matches = []
+            for field, value in (('country', country), ('city', city), ('protocol', protocol)):
+                if value:
+                    matches.append(self.indexes[field].get(value, ()))
+            if max_latency is not None:
+                buckets = self.latency_index[:self.latency_bucket(max_latency) + 1]
+                matches.append(set().union(*buckets))
+            if not matches:
+                return list(self.items)
+            matches.sort(key=len)
+            keys = set(matches[0]).intersection(*matches[1:])
+            records = [self.items[self.positions[key]] for key in keys]
+        if max_latency is not None:
+            # Buckets are coarse; the last one holds everything slower than its bound
+            # An unmeasured (None) latency counts as 5000ms, as it does for the buckets
+            records = [p for p in records
+                       if (5000 if p.get('latency') is None else p['latency']) <= max_latency]
+        return records
+
+    def values(self, field):
+        """Distinct values of an indexed field with how many proxies have each"""
+        with self.lock:
+            return {value: len(keys) for value, keys in self.indexes[field].items()}
+
+    def extend(self, proxies):
+        self.merge(proxies)
+
+    def remove(self, key):
+        """Drop a proxy in O(1) by moving the last record into its slot"""
+        with self.lock:
+            position = self.positions.pop(key, None)
+            if position is None:
+                return None
+            removed = self.items[position]
+            self._unindex(key, removed)
+            last = self.items.pop()
+            if position < len(self.items):
+                self.items[position] = last
+                self.positions[proxy_key(last)] = position
+            return removed
+
+    def trim(self, limit):
+        """Evict the least promising proxies once the pool grows past limit"""
+        with self.lock:
+            excess = len(self.items) - limit
+            if excess <= 0:
+                return 0
+            worst = sorted(
+                self.items,
+                key=lambda p: (p.get('failures', 0) - p.get('successes', 0), p.get('latency', 0)),
+                reverse=True
+            )[:excess]
+            for proxy in worst:
+                self.remove(proxy_key(proxy))
+            return excess
+
+# ===== ADAPTIVE PROXY SELECTION =====
+def backoff_delay(attempt, base=30, cap=3600):
+    """Exponential backoff with equal jitter: half the delay fixed, half random"""
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class ProxyBreaker:
+    """Per-proxy circuit breaker kept on the pool record: closed, open, then half-open"""
+    def __init__(self, threshold=1, base=30, cap=3600, probe_timeout=30):
+        self.threshold = threshold
+        self.base = base
+        self.cap = cap
+        self.probe_timeout = probe_timeout
+
+    def state(self, proxy, now=None):
+        open_until = proxy.get('open_until')
+        if not open_until:
+            return 'closed'
+        return 'open' if (now or time.time()) < open_until else 'half_open'
+
+    def available(self, proxy, now=None):
+        """Whether a check may be spent on this proxy, without claiming the probe"""
+        # Called for every pool entry on each selection; read record slots directly
+        open_until = proxy.open_until if proxy.__class__ is ProxyRecord else proxy.get('open_until')
+        if not open_until:
+            return True
+        now = now or time.time()
+        if now < open_until:
+            return False
+        # Half-open: one probe at a time; a probe that never reported back expires
+        return now - proxy.get('probe_at', 0) >= self.probe_timeout
+
+    def allow(self, proxy, now=None):
+        """Claim a check; a half-open proxy admits a single probe"""
+        now = now or time.time()
+        if not self.available(proxy, now):
+            return False
+        if self.state(proxy, now) == 'half_open':
+            proxy['probe_at'] = now
+        return True
+
+    def record(self, proxy, ok, now=None):
+        now = now or time.time()
+        proxy.pop('probe_at', None)
+        if ok:
+            proxy['fail_streak'] = 0
+            proxy.pop('open_until', None)
+            return
+        proxy['fail_streak'] = proxy.get('fail_streak', 0) + 1
+        if proxy['fail_streak'] >= self.threshold:
+            attempt = proxy['fail_streak'] - self.threshold
+            proxy['open_until'] = now + backoff_delay(attempt, self.base, self.cap)
+
+class ProxySelector:
+    """Orders proxies by expected cost per successful request, learning from every check"""
+    EWMA_ALPHA = 0.3
+    # Most listed free proxies are dead, so an untested one starts at a 25% success estimate
+    PRIOR_SUCCESSES = 1
+    PRIOR_FAILURES = 3
+
+    def __init__(self, cooldown=300, half_life=3600, shortlist_factor=4, rng=None, breaker=None):
+        self.breaker = breaker or ProxyBreaker()
+        self.cooldown = cooldown
+        self.half_life = half_life
+        self.shortlist_factor = shortlist_factor
+        self.rng = rng or random.Random()
+
+    def score(self, proxy, now=None):
+        """Expected milliseconds per success; lower is better"""
+        now = now or time.time()
+        if proxy.__class__ is ProxyRecord:
+            # Plain slot reads; this runs for every pool entry on each rotation
+            tested_at, successes, failures = proxy.tested_at, proxy.successes or 0, proxy.failures or 0
+            latency, used_at = proxy.latency, proxy.used_at
+        else:
+            tested_at, successes, failures = (proxy.get('tested_at'), proxy.get('successes', 0),
+                                              proxy.get('failures', 0))
+            latency, used_at = proxy.get('latency'), proxy.get('used_at')
+        # Old evidence decays towards the prior, so yesterday's results count for less
+        weight = 0.5 ** ((now - tested_at) / self.half_life) if tested_at else 1.0
+        successes *= weight
+        failures *= weight
+        success_rate = (successes + self.PRIOR_SUCCESSES) / (
+            successes + failures + self.PRIOR_SUCCESSES + self.PRIOR_FAILURES)
+        cost = max(5000 if latency is None else latency, 1) / success_rate
+        # A proxy we just rotated onto rests before it is favoured again
+        if used_at:
+            cost *= 1 + 2 * 0.5 ** ((now - used_at) / self.cooldown)
+        return cost
+
+    def order(self, proxies, limit=None):
+        """Sample up to `limit` proxies best-first with power-of-two-choices"""
+        now = time.time()
+        scored = [(self.score(proxy, now), proxy) for proxy in proxies
+                  if self.breaker.available(proxy, now)]
+        if limit:
+            # Only the strongest few compete, but randomly, so load spreads across them
+            scored = heapq.nsmallest(limit * self.shortlist_factor, scored, key=lambda item: item[0])
+        ordered = []
+        while scored and (limit is None or len(ordered) < limit):
+            first = self.rng.randrange(len(scored))
+            second = self.rng.randrange(len(scored))
+            pick = first if scored[first][0] <= scored[second][0] else second
+            ordered.append(scored[pick][1])
+            scored[pick] = scored[-1]
+            scored.pop()
+        return ordered
+
+    def pick(self, proxies, tries=8):
+        """Power-of-two-choices on random draws, without scoring every candidate"""
+        now = time.time()
+        best = None
+        drawn = 0
+        for _ in range(tries if proxies else 0):
+            proxy = proxies[self.rng.randrange(len(proxies))]
+            if not self.breaker.available(proxy, now):
+                continue
+            score = self.score(proxy, now)
+            if best is None or score < best[0]:
+                best = (score, proxy)
+            drawn += 1
+            if drawn == 2:
+                break
+        if best is None and proxies:
+            # Every draw hit a cooling proxy; fall back to a full pass
+            ordered = self.order(proxies, 1)
+            return ordered[0] if ordered else None
+        return best[1] if best else None
+
+    def record(self, proxy, result, now=None):
+        """Fold a check result into the pool record in place"""
+        now = now or time.time()
+        proxy['tested_at'] = now
+        if result.get('working'):
+            proxy['successes'] = proxy.get('successes', 0) + 1
+            measured = result['latency']
+            # Until a proxy is measured, its latency is the API's guess and is simply replaced
+            if proxy.get('ip'):
+                measured = proxy['latency'] * (1 - self.EWMA_ALPHA) + measured * self.EWMA_ALPHA
+            proxy['latency'] = int(measured)
+            proxy['ip'] = result['ip']
+        else:
+            proxy['failures'] = proxy.get('failures', 0) + 1
+
+    def mark_used(self, proxy):
+        proxy['used_at'] = time.time()
+
+# ===== BACKGROUND POOL REFRESHER =====
+class StandbyQueue:
+    """Recently verified proxies (with exit IPs) ready for instant rotation"""
+    def __init__(self, capacity=5, ttl=120):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = deque()
+        self.keys = set()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _purge(self, now):
+        while self.entries and self.entries[0][0] <= now:
+            _, proxy = self.entries.popleft()
+            self.keys.discard(proxy_key(proxy))
+
+    def push(self, proxy, verified_at=None):
+        with self.lock:
+            key = proxy_key(proxy)
+            if key in self.keys or len(self.entries) >= self.capacity:
+                return False
+            self.entries.append(((verified_at or time.time()) + self.ttl, proxy))
+            self.keys.add(key)
+            return True
+
+    def pop(self):
+        """Oldest still-fresh proxy in O(1), or None"""
+        with self.lock:
+            self._purge(time.time())
+            if not self.entries:
+                return None
+            _, proxy = self.entries.popleft()
+            self.keys.discard(proxy_key(proxy))
+            return proxy
+
+    def discard(self, proxy):
+        """Forget a proxy that was just found dead"""
+        with self.lock:
+            key = proxy_key(proxy)
+            if key in self.keys:
+                self.keys.discard(key)
+                self.entries = deque(e for e in self.entries if proxy_key(e[1]) != key)
+
+    def take_stale(self, age):
+        """Remove and return entries verified more than `age` seconds ago, oldest first"""
+        with self.lock:
+            now = time.time()
+            self._purge(now)
+            cutoff = now - age + self.ttl
+            stale = []
+            while self.entries and self.entries[0][0] <= cutoff:
+                _, proxy = self.entries.popleft()
+                self.keys.discard(proxy_key(proxy))
+                stale.append(proxy)
+            return stale
+
+    def needed(self):
+        with self.lock:
+            self._purge(time.time())
+            return self.capacity - len(self.entries)
+
+    def snapshot(self):
+        with self.lock:
+            return set(self.keys)
+
+class PoolRefresher:
+    """Refetches the pool in the background and keeps a standby queue of verified proxies full"""
+    def __init__(self, fetch, validate, interval_min=60, standby_size=5, standby_ttl=120, log=None):
+        self.fetch = fetch
+        self.validate = validate
+        self.interval = max(1, interval_min) * 60
+        self.standby = StandbyQueue(standby_size, standby_ttl)
+        # Revalidate well before entries expire so the queue never runs dry
+        self.revalidate_every = max(5, standby_ttl / 2)
+        self.log = log or (lambda message: None)
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.last_refresh = None
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread and self.thread.is_alive():
+            self.thread.join(timeout=2)
+
+    def run(self):
+        next_fetch = 0
+        while not self.stopped.is_set():
+            try:
+                if time.time() >= next_fetch:
+                    next_fetch = time.time() + self.interval
+                    self.fetch()
+                    self.last_refresh = time.time()
+                self.top_up()
+            except Exception as e:
+                self.log(f"Background refresh failed: {str(e)}")
+            # Sleep until the next fetch or revalidation, or until rotation drains the queue
+            self.wakeup.wait(max(0, min(next_fetch - time.time(), self.revalidate_every)))
+            self.wakeup.clear()
+
+    def top_up(self):
+        """Re-check aging standby entries, then validate enough fresh proxies to refill the queue"""
+        stale = self.standby.take_stale(self.revalidate_every)
+        if stale:
+            working = self.validate(len(stale), exclude=self.standby.snapshot(), candidates=stale)
+            for proxy in working:
+                self.standby.push(proxy)
+            self.log(f"Standby queue re-checked: {len(working)}/{len(stale)} aging proxies still working")
+        needed = self.standby.needed()
+        if needed <= 0:
+            return
+        working = self.validate(needed, exclude=self.standby.snapshot())
+        for proxy in working:
+            self.standby.push(proxy)
+        self.log(f"Standby queue refilled: {len(self.standby)}/{self.standby.capacity} verified proxies")
+
+    def pop(self):
+        """Take a verified proxy without waiting; None if the queue is empty"""
+        proxy = self.standby.pop()
+        if self.standby.needed() > 0:
+            self.wakeup.set()
+        return proxy
+
+    def discard(self, proxy):
+        self.standby.discard(proxy)
+        self.wakeup.set()
+
+# ===== SHARED HTTP SESSIONS =====
+class SessionFactory:
+    """Pooled requests sessions: one for direct calls and one per proxy URL"""
+    def __init__(self, pool_size=100, max_proxy_sessions=None, proxy_pool_size=4):
+        self.pool_size = pool_size
+        self.proxy_pool_size = proxy_pool_size
+        self.max_proxy_sessions = max_proxy_sessions or pool_size
+        self.lock = threading.Lock()
+        self.direct_session = None
+        self.proxy_sessions = OrderedDict()
+
+    def _build(self, pool_size, proxy_url=None):
+        session = requests.Session()
+        # Don't let HTTP_PROXY set by set_termux_proxy leak into these calls
+        session.trust_env = False
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if proxy_url:
+            session.proxies = {'http': proxy_url, 'https': proxy_url}
+        return session
+
+    @staticmethod
+    def proxy_url(proxy):
+        return f"{proxy['protocol']}://{proxy['host']}:{proxy['port']}"
+
+    def direct(self):
+        """Session for calls that must not go through a proxy"""
+        with self.lock:
+            if self.direct_session is None:
+                self.direct_session = self._build(self.pool_size)
+            return self.direct_session
+
+    def for_proxy(self, proxy):
+        """Session whose connections all go through this proxy"""
+        url = proxy if isinstance(proxy, str) else self.proxy_url(proxy)
+        with self.lock:
+            session = self.proxy_sessions.get(url)
+            if session is None:
+                session = self._build(self.proxy_pool_size, url)
+                self.proxy_sessions[url] = session
+                if len(self.proxy_sessions) > self.max_proxy_sessions:
+                    _, oldest = self.proxy_sessions.popitem(last=False)
+                    oldest.close()
+            else:
+                self.proxy_sessions.move_to_end(url)
+            return session
+
+    def discard(self, proxy):
+        """Drop a proxy's pooled connections, e.g. after it failed"""
+        url = proxy if isinstance(proxy, str) else self.proxy_url(proxy)
+        with self.lock:
+            session = self.proxy_sessions.pop(url, None)
+        if session:
+            session.close()
+
+    def close_all(self):
+        with self.lock:
+            sessions = list(self.proxy_sessions.values())
+            self.proxy_sessions.clear()
+            if self.direct_session:
+                sessions.append(self.direct_session)
+                self.direct_session = None
+        for session in sessions:
+            session.close()
+
+class ExitIPCache:
+    """Observed exit IP per proxy, reused for `ttl` seconds
+
+    Concurrent lookups for the same proxy share one in-flight check instead of
+    each sending a request. check(proxy, **kwargs) returns a dict with at least
+    'ip' or raises; proxy None means the direct connection.
+    """
+    def __init__(self, check, ttl=60):
+        self.check = check
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.inflight = {}
+        self.swept_at = time.time()
+
+    @staticmethod
+    def key(proxy):
+        if proxy is None or isinstance(proxy, str):
+            return proxy or 'direct'
+        return proxy_key(proxy)
+
+    def get(self, proxy, max_age=None, **check_args):
+        key = self.key(proxy)
+        max_age = self.ttl if max_age is None else max_age
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.time() - entry['checked_at'] < max_age:
+                return entry
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.inflight[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            entry = {**self.check(proxy, **check_args), 'checked_at': time.time()}
+        except BaseException as e:
+            with self.lock:
+                del self.inflight[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            self._store(key, entry)
+            del self.inflight[key]
+        future.set_result(entry)
+        return entry
+
+    def put(self, proxy, ip, **fields):
+        """Record an exit IP observed elsewhere, e.g. by the validator"""
+        with self.lock:
+            self._store(self.key(proxy), {'ip': ip, **fields, 'checked_at': time.time()})
+
+    def _store(self, key, entry):
+        # Drop expired entries at most once per ttl, so a large pool doesn't accumulate them
+        self.entries[key] = entry
+        now = entry['checked_at']
+        if now - self.swept_at >= self.ttl:
+            self.swept_at = now
+            self.entries = {k: e for k, e in self.entries.items() if now - e['checked_at'] < self.ttl}
+
+    def invalidate(self, proxy):
+        with self.lock:
+            self.entries.pop(self.key(proxy), None)
+
+# ===== ASYNC PROXY VALIDATOR =====
+def proxy_key(proxy):
+    """Identity of a proxy across fetches, pools and stores"""
+    return (proxy['host'], int(proxy['port']), proxy['protocol'])
+
+async def _open_socket(host, port, timeout):
+    """Open a non-blocking TCP socket to host:port"""
+    loop = asyncio.get_running_loop()
+    infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    family, socktype, proto, _, addr = infos[0]
+    sock = socket.socket(family, socktype, proto)
+    sock.setblocking(False)
+    try:
+        await asyncio.wait_for(loop.sock_connect(sock, addr), timeout)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+async def _recv_exact(sock, size):
+    """Read exactly size bytes from a non-blocking socket"""
+    loop = asyncio.get_running_loop()
+    data = b''
+    while len(data) < size:
+        chunk = await loop.sock_recv(sock, size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed during handshake")
+        data += chunk
+    return data
+
+async def _recv_head(sock, limit=65536):
+    """Read up to the end of an HTTP header block, returning (head, leftover)"""
+    loop = asyncio.get_running_loop()
+    data = b''
+    while b'\r\n\r\n' not in data:
+        if len(data) > limit:
+            raise ConnectionError("HTTP header block too large")
+        chunk = await loop.sock_recv(sock, 4096)
+        if not chunk:
+            raise ConnectionError("Connection closed before headers completed")
+        data += chunk
+    head, _, rest = data.partition(b'\r\n\r\n')
+    return head, rest
+
+def _socks_address(host):
+    """Encode a destination host for a SOCKS5 request"""
+    try:
+        ip = ipaddress.ip_address(host)
+        return (b'\x01' if ip.version == 4 else b'\x04') + ip.packed
+    except ValueError:
+        name = host.encode('idna')
+        return b'\x03' + bytes([len(name)]) + name
+
+async def proxy_handshake(sock, proxy, host, port):
+    """Ask an upstream proxy to tunnel sock to host:port, returning leftover bytes"""
+    loop = asyncio.get_running_loop()
+    protocol = proxy['protocol']
+    if protocol == 'socks5':
+        await loop.sock_sendall(sock, b'\x05\x01\x00')
+        if await _recv_exact(sock, 2) != b'\x05\x00':
+            raise ConnectionError("SOCKS5 authentication rejected")
+        await loop.sock_sendall(sock, b'\x05\x01\x00' + _socks_address(host) + struct.pack('!H', port))
+        reply = await _recv_exact(sock, 4)
+        if reply[1] != 0:
+            raise ConnectionError(f"SOCKS5 connect failed (code {reply[1]})")
+        if reply[3] == 1:
+            await _recv_exact(sock, 6)
+        elif reply[3] == 4:
+            await _recv_exact(sock, 18)
+        else:
+            length = (await _recv_exact(sock, 1))[0]
+            await _recv_exact(sock, length + 2)
+        return b''
+    if protocol == 'socks4':
+        try:
+            address = ipaddress.IPv4Address(host).packed
+            suffix = b''
+        except ValueError:
+            # SOCKS4a: let the proxy resolve the name
+            address = b'\x00\x00\x00\x01'
+            suffix = host.encode('idna') + b'\x00'
+        await loop.sock_sendall(sock, b'\x04\x01' + struct.pack('!H', port) + address + b'\x00' + suffix)
+        reply = await _recv_exact(sock, 8)
+        if reply[1] != 0x5a:
+            raise ConnectionError(f"SOCKS4 connect failed (code {reply[1]})")
+        return b''
+    # HTTP and HTTPS proxies both tunnel with CONNECT
+    target = f"{host}:{port}"
+    await loop.sock_sendall(sock, f"CONNECT {target} HTTP/1.1\r\nHost: {target}\r\n\r\n".encode())
+    head, rest = await _recv_head(sock)
+    status_line = head.split(b'\r\n', 1)[0]
+    status = status_line.split()
+    if len(status) < 2 or status[1] != b'200':
+        raise ConnectionError(f"CONNECT refused: {status_line.decode(errors='replace')}")
+    return rest
+
+async def proxy_http_get(proxy, url, timeout, user_agent="Mozilla/5.0", max_body=65536, connected=None):
+    """Fetch a plain-HTTP URL through a proxy, returning (status, body)
+
+    `connected`, an asyncio.Event, is set once the proxy has accepted the tunnel.
+    """
+    loop = asyncio.get_running_loop()
+    parsed = urlparse(url)
+    host = parsed.hostname
+    port = parsed.port or 80
+    path = parsed.path or '/'
+    if parsed.query:
+        path += '?' + parsed.query
+
+    sock = await _open_socket(proxy['host'], int(proxy['port']), timeout)
+    try:
+        if proxy['protocol'] in ('http', 'https'):
+            # HTTP proxies take an absolute-form request line directly
+            target = url
+            data = b''
+        else:
+            target = path
+            data = await proxy_handshake(sock, proxy, host, port)
+        if connected is not None:
+            connected.set()
+        request = (
+            f"GET {target} HTTP/1.0\r\n"
+            f"Host: {parsed.netloc}\r\n"
+            f"User-Agent: {user_agent}\r\n"
+            "Accept: */*\r\n"
+            "Connection: close\r\n\r\n"
+        )
+        await loop.sock_sendall(sock, request.encode())
+        while len(data) < max_body:
+            chunk = await loop.sock_recv(sock, 4096)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+
+    head, _, body = data.partition(b'\r\n\r\n')
+    status = head.split(b'\r\n', 1)[0].split()
+    if len(status) < 2 or not status[1].isdigit():
+        raise ConnectionError("Malformed HTTP response from proxy")
+    return int(status[1]), body
+
+class IPEchoError(ValueError):
+    """The echo service answered, but not with an address"""
+
+def parse_echo_ip(status, body):
+    """Address from an IP echo reply; free proxies often answer 200 with a captive page"""
+    ip = body.decode(errors='replace').strip() if isinstance(body, bytes) else body.strip()
+    if status != 200:
+        raise IPEchoError(f"IP echo answered HTTP {status}")
+    try:
+        return str(ipaddress.ip_address(ip))
+    except ValueError:
+        raise IPEchoError(f"IP echo answered {ip[:40]!r}") from None
+
+class TunnelReady(asyncio.Event):
+    """Set by proxy_http_get once the tunnel is up, remembering when"""
+    started = None
+
+    def set(self):
+        self.started = time.monotonic()
+        super().set()
+
+class IPEchoEndpoints:
+    """IP echo services shared by every check, with rotation and hedged requests
+
+    Each check starts on the next service in turn so consecutive proxies spread
+    across them. Only the echo service's side is hedged: once the proxy has
+    accepted the tunnel, a reply slower than twice the median reply time sends
+    the same check to the next service and the first answer wins. An HTTP or
+    parse error from a service also hands over to the next one. Connect errors
+    and timeouts are the proxy's fault and are never retried elsewhere.
+    """
+    def __init__(self, urls=IP_CHECK_URLS, hedges=1, initial_delay=1.0, min_delay=0.2,
+                 max_delay=3.0, window=64, workers=8):
+        self.urls = list(urls) or list(IP_CHECK_URLS)
+        self.attempts = min(len(self.urls), 1 + hedges)
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.latencies = deque(maxlen=window)
+        self.turn = 0
+        self.lock = threading.Lock()
+        self.workers = workers
+        self.executor = None
+
+    def order(self):
+        """Services for the next check, starting one further along than the last"""
+        with self.lock:
+            start = self.turn
+            self.turn = (self.turn + 1) % len(self.urls)
+        return [self.urls[(start + i) % len(self.urls)] for i in range(self.attempts)]
+
+    def observe(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def hedge_delay(self):
+        """Twice the median reply time, clamped; a reply slower than this gets hedged"""
+        with self.lock:
+            if len(self.latencies) < 5:
+                return self.initial_delay
+            p50 = statistics.median(self.latencies)
+        return min(self.max_delay, max(self.min_delay, 2 * p50))
+
+    async def first_async(self, fetch, slots=None):
+        """Await fetch(url, connected) across services, returning the first successful result
+
+        fetch sets `connected` once its tunnel is up. Every attempt holds one of
+        `slots` (an asyncio.Semaphore shared by the whole validation run) while its
+        socket is open; a hedge is only sent if a slot is free right away.
+        """
+        urls = self.order()
+        pending = {}
+        error = None
+
+        async def attempt(url, connected):
+            if slots is None:
+                return await fetch(url, connected)
+            async with slots:
+                return await fetch(url, connected)
+
+        def launch():
+            connected = TunnelReady()
+            pending[asyncio.ensure_future(attempt(urls.pop(0), connected))] = connected
+
+        launch()
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, timeout=self.hedge_delay() if urls else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    connected = pending.pop(task)
+                    if task.exception() is None:
+                        if connected.is_set():
+                            self.observe(time.monotonic() - connected.started)
+                        return task.result()
+                    error = task.exception()
+                    # The service misbehaved, not the proxy: ask the next one
+                    if isinstance(error, IPEchoError) and urls:
+                        launch()
+                if done or not urls:
+                    continue
+                # Hedge only a tunnel that is up but waiting on a slow service
+                tunnels = [c for c in pending.values() if c.is_set()]
+                if (len(tunnels) == len(pending)
+                        and time.monotonic() - max(c.started for c in tunnels) >= self.hedge_delay()
+                        and (slots is None or not slots.locked())):
+                    launch()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def first(self, fetch):
+        """Blocking counterpart of first_async for single session-based checks
+
+        requests doesn't report when the tunnel is up, so the hedge delay counts
+        from the start of the attempt and at most one hedge is sent.
+        """
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ip-echo')
+        urls = self.order()
+        pending = {}
+        error = None
+
+        def launch():
+            pending[self.executor.submit(fetch, urls.pop(0))] = time.monotonic()
+
+        launch()
+        while pending:
+            done, _ = wait(pending, timeout=self.hedge_delay() if urls else None,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.pop(future)
+                if future.exception() is None:
+                    # Losing attempts finish in the background; their result is dropped
+                    return future.result()
+                error = future.exception()
+                if isinstance(error, IPEchoError) and urls:
+                    launch()
+            if not done and urls and len(pending) == 1:
+                launch()
+        raise error
+
+class IPEchoServer:
+    """Local stand-in for an IP echo service, e.g. to exercise the validator offline
+
+    Replies to every GET with the client address, optionally after `delay` seconds
+    so hedging can be observed.
+    """
+    def __init__(self, host='127.0.0.1', port=0, delay=0):
+        delay_ = delay
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if delay_:
+                    time.sleep(delay_)
+                body = f"{self.client_address[0]}\n".encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class AsyncProxyValidator:
+    """Check many proxies at once with a cap on sockets in flight"""
+    def __init__(self, endpoints=None, max_in_flight=100, timeout=5, user_agent="Mozilla/5.0",
+                 breaker=None):
+        self.endpoints = endpoints or IPEchoEndpoints()
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.timeout = timeout
+        self.user_agent = user_agent
+        self.breaker = breaker
+
+    async def check(self, proxy, slots=None):
+        """Test a single proxy against the IP echo services"""
+        start = time.time()
+
+        async def ask(url, connected):
+            status, body = await proxy_http_get(proxy, url, self.timeout, self.user_agent,
+                                                connected=connected)
+            return parse_echo_ip(status, body), len(body)
+
+        try:
+            ip, size = await asyncio.wait_for(self.endpoints.first_async(ask, slots), self.timeout)
+            return {
+                'working': True,
+                'ip': ip,
+                'latency': int((time.time() - start) * 1000),
+                'bytes': size
+            }
+        except (OSError, ValueError, asyncio.TimeoutError, ConnectionError):
+            pass
+        return {'working': False}
+
+    async def validate(self, proxies, want=1, on_result=None):
+        """Return up to `want` working proxies, cancelling outstanding checks once satisfied"""
+        found = []
+        candidates = iter(proxies)
+        pending = {}
+        # Hedged attempts open extra sockets; they share this cap with the checks themselves
+        slots = asyncio.Semaphore(self.max_in_flight)
+
+        def launch():
+            for proxy in candidates:
+                # Proxies whose circuit is open are skipped rather than spent a timeout on
+                if self.breaker and not self.breaker.allow(proxy):
+                    continue
+                pending[asyncio.ensure_future(self.check(proxy, slots))] = proxy
+                if len(pending) >= self.max_in_flight:
+                    break
+
+        launch()
+        try:
+            while pending and (want is None or len(found) < want):
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    proxy = pending.pop(task)
+                    result = task.result()
+                    if self.breaker:
+                        self.breaker.record(proxy, result['working'])
+                    if on_result:
+                        on_result(proxy, result)
+                    if result['working']:
+                        found.append({**proxy, **result})
+                launch()
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        return found if want is None else found[:want]
+
+    def validate_sync(self, proxies, want=1, on_result=None):
+        """Blocking wrapper for callers on plain threads"""
+        return asyncio.run(self.validate(proxies, want, on_result))
+
+# ===== PROXY HEALTH STORE =====
+class ProxyHealthStore:
+    """SQLite record of every proxy we have seen and how it behaved"""
+    EWMA_ALPHA = 0.3
+    COLUMNS = ("host", "port", "protocol", "country", "city", "api_latency", "successes",
+               "failures", "latency_ewma", "last_ip", "last_seen", "last_checked", "last_success")
+
+    def __init__(self, path=HEALTH_DB):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS proxies (
+                host TEXT NOT NULL,
+                port INTEGER NOT NULL,
+                protocol TEXT NOT NULL,
+                country TEXT,
+                city TEXT,
+                api_latency INTEGER,
+                successes INTEGER NOT NULL DEFAULT 0,
+                failures INTEGER NOT NULL DEFAULT 0,
+                latency_ewma REAL,
+                last_ip TEXT,
+                last_seen REAL,
+                last_checked REAL,
+                last_success REAL,
+                PRIMARY KEY (host, port, protocol)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_proxies_country ON proxies(country);
+            CREATE INDEX IF NOT EXISTS idx_proxies_last_seen ON proxies(last_seen);
+            CREATE INDEX IF NOT EXISTS idx_proxies_last_success ON proxies(last_success);
+        """)
+        self.db.commit()
+
+    def upsert_seen(self, proxies):
+        """Record proxies returned by a fetch, keeping their health history"""
+        now = time.time()
+        rows = [
+            (p['host'], int(p['port']), p['protocol'], p.get('country'), p.get('city'),
+             p.get('latency'), now)
+            for p in proxies
+        ]
+        with self.lock:
+            self.db.executemany("""
+                INSERT INTO proxies (host, port, protocol, country, city, api_latency, last_seen)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (host, port, protocol) DO UPDATE SET
+                    country = COALESCE(excluded.country, country),
+                    city = COALESCE(excluded.city, city),
+                    api_latency = excluded.api_latency,
+                    last_seen = excluded.last_seen
+            """, rows)
+            self.db.commit()
+
+    def record_results(self, results):
+        """Fold (proxy, result) validation outcomes into counters and latency EWMA"""
+        now = time.time()
+        alpha = self.EWMA_ALPHA
+        rows = []
+        for proxy, result in results:
+            ok = 1 if result.get('working') else 0
+            latency = result.get('latency') if ok else None
+            rows.append((
+                proxy['host'], int(proxy['port']), proxy['protocol'], proxy.get('country'),
+                ok, 1 - ok, latency, result.get('ip'), now, now if ok else None
+            ))
+        with self.lock:
+            self.db.executemany(f"""
+                INSERT INTO proxies (host, port, protocol, country, successes, failures,
+                                     latency_ewma, last_ip, last_checked, last_success)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (host, port, protocol) DO UPDATE SET
+                    successes = successes + excluded.successes,
+                    failures = failures + excluded.failures,
+                    latency_ewma = CASE
+                        WHEN excluded.latency_ewma IS NULL THEN latency_ewma
+                        WHEN latency_ewma IS NULL THEN excluded.latency_ewma
+                        ELSE latency_ewma * {1 - alpha} + excluded.latency_ewma * {alpha}
+                    END,
+                    last_ip = COALESCE(excluded.last_ip, last_ip),
+                    last_checked = excluded.last_checked,
+                    last_success = COALESCE(excluded.last_success, last_success)
+            """, rows)
+            self.db.commit()
+
+    def ranked(self, limit=500, max_age_hours=24, country=None):
+        """Best recently seen proxies, most reliable and fastest first"""
+        since = time.time() - max_age_hours * 3600
+        query = f"""
+            SELECT {", ".join(self.COLUMNS)} FROM proxies
+            WHERE (last_seen >= ? OR last_success >= ?)
+        """
+        params = [since, since]
+        if country:
+            query += " AND country = ?"
+            params.append(country)
+        query += """
+            ORDER BY (successes + 1.0) / (successes + failures + 2.0) DESC,
+                     COALESCE(latency_ewma, api_latency, 5000) ASC
+            LIMIT ?
+        """
+        params.append(limit)
+        with self.lock:
+            rows = self.db.execute(query, params).fetchall()
+        return [self._to_proxy(dict(zip(self.COLUMNS, row))) for row in rows]
+
+    def stats(self):
+        """Summary counts for display"""
+        with self.lock:
+            total, healthy = self.db.execute(
+                "SELECT COUNT(*), COUNT(last_success) FROM proxies"
+            ).fetchone()
+        return {'total': total, 'ever_worked': healthy}
+
+    def prune(self, days=7):
+        """Forget proxies not seen or working for `days`"""
+        cutoff = time.time() - days * 86400
+        with self.lock:
+            cursor = self.db.execute(
+                "DELETE FROM proxies WHERE COALESCE(last_seen, 0) < ? AND COALESCE(last_success, 0) < ?",
+                (cutoff, cutoff)
+            )
+            self.db.commit()
+        return cursor.rowcount
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    @staticmethod
+    def _to_proxy(row):
+        """Shape a row like a fetched pool entry"""
+        latency = row['latency_ewma'] if row['latency_ewma'] is not None else row['api_latency']
+        proxy = {
+            'host': row['host'],
+            'port': row['port'],
+            'protocol': row['protocol'],
+            'country': row['country'] or '',
+            'latency': int(latency) if latency is not None else 5000,
+            'successes': row['successes'],
+            'failures': row['failures'],
+        }
+        if row['city']:
+            proxy['city'] = row['city']
+        if row['last_ip']:
+            proxy['ip'] = row['last_ip']
+        if row['last_checked']:
+            proxy['last_checked'] = datetime.fromtimestamp(row['last_checked']).isoformat()
+            proxy['tested_at'] = row['last_checked']
+        return proxy
+
+# ===== LOCAL FORWARDING PROXY =====
+class _SocketBuffer:
+    """Buffered reads over a non-blocking socket for protocol parsing"""
+    def __init__(self, sock, data=b''):
+        self.sock = sock
+        self.data = data
+
+    async def fill(self):
+        chunk = await asyncio.get_running_loop().sock_recv(self.sock, 4096)
+        if not chunk:
+            raise ConnectionError("Client closed the connection")
+        self.data += chunk
+
+    async def read_exact(self, size):
+        while len(self.data) < size:
+            await self.fill()
+        chunk, self.data = self.data[:size], self.data[size:]
+        return chunk
+
+    async def read_until(self, separator, limit=65536):
+        while separator not in self.data:
+            if len(self.data) > limit:
+                raise ConnectionError("Request header block too large")
+            await self.fill()
+        chunk, _, self.data = self.data.partition(separator)
+        return chunk
+
+    async def at_eof(self):
+        """True if the peer closed before sending anything more"""
+        if self.data:
+            return False
+        chunk = await asyncio.get_running_loop().sock_recv(self.sock, 4096)
+        self.data += chunk
+        return not chunk
+
+    def drain(self):
+        rest, self.data = self.data, b''
+        return rest
+
+HOP_BY_HOP_HEADERS = (b'connection', b'proxy-connection', b'keep-alive', b'proxy-authorization')
+IDEMPOTENT_METHODS = (b'GET', b'HEAD', b'OPTIONS', b'PUT', b'DELETE', b'TRACE')
+
+def _header_map(head):
+    """Lower-cased header name -> value for an HTTP header block"""
+    headers = {}
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        headers[name.strip().lower()] = value.strip()
+    return headers
+
+def _wants_keep_alive(version, headers):
+    connection = headers.get(b'connection', headers.get(b'proxy-connection', b'')).lower()
+    if version.upper() == b'HTTP/1.0':
+        return connection == b'keep-alive'
+    return connection != b'close'
+
+def _rewrite_request_head(head, origin_form, keep_alive=False):
+    """Strip hop-by-hop headers and set our own connection handling"""
+    lines = head.split(b'\r\n')
+    method, target, version = lines[0].split(b' ', 2)
+    if origin_form:
+        parsed = urlparse(target.decode('latin-1'))
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        target = path.encode('latin-1')
+    headers = [line for line in lines[1:] if line.split(b':', 1)[0].strip().lower() not in HOP_BY_HOP_HEADERS]
+    headers.append(b'Connection: keep-alive' if keep_alive else b'Connection: close')
+    return b'\r\n'.join([b' '.join((method, target, version))] + headers) + b'\r\n\r\n'
+
+def _rewrite_response_head(head, keep_alive):
+    lines = head.split(b'\r\n')
+    headers = [line for line in lines[1:] if line.split(b':', 1)[0].strip().lower() not in HOP_BY_HOP_HEADERS]
+    headers.append(b'Connection: keep-alive' if keep_alive else b'Connection: close')
+    return b'\r\n'.join([lines[0]] + headers) + b'\r\n\r\n'
+
+class UpstreamPool:
+    """Idle keep-alive connections to upstream proxies, keyed by (host, port, protocol)"""
+    def __init__(self, idle_timeout=30, max_per_host=8):
+        self.idle_timeout = idle_timeout
+        self.max_per_host = max_per_host
+        self.idle = {}
+        self.stats = {'opened': 0, 'reused': 0, 'evicted': 0}
+
+    @staticmethod
+    def _alive(sock):
+        """An idle proxy connection must have nothing to read and not be closed"""
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return True
+        except OSError:
+            pass
+        return False
+
+    async def acquire(self, proxy, timeout):
+        """Return (socket, reused) connected to the proxy itself"""
+        connections = self.idle.get(proxy_key(proxy), [])
+        deadline = time.monotonic() - self.idle_timeout
+        while connections:
+            sock, idle_since = connections.pop()
+            if idle_since >= deadline and self._alive(sock):
+                self.stats['reused'] += 1
+                return sock, True
+            sock.close()
+        sock = await _open_socket(proxy['host'], int(proxy['port']), timeout)
+        self.stats['opened'] += 1
+        return sock, False
+
+    def release(self, proxy, sock):
+        """Park a connection for reuse, or close it if the host is full"""
+        connections = self.idle.setdefault(proxy_key(proxy), [])
+        if len(connections) >= self.max_per_host:
+            sock.close()
+            return
+        connections.append((sock, time.monotonic()))
+
+    async def prewarm(self, proxy, count, timeout):
+        """Open spare connections so the next tunnel skips the TCP handshake"""
+        while len(self.idle.get(proxy_key(proxy), [])) < min(count, self.max_per_host):
+            try:
+                sock = await _open_socket(proxy['host'], int(proxy['port']), timeout)
+            except (OSError, asyncio.TimeoutError):
+                return
+            self.stats['opened'] += 1
+            self.release(proxy, sock)
+
+    def evict(self, key):
+        """Drop every idle connection to an upstream that was found dead"""
+        for sock, _ in self.idle.pop(key, []):
+            sock.close()
+            self.stats['evicted'] += 1
+
+    def reap(self):
+        """Close connections idle longer than idle_timeout"""
+        deadline = time.monotonic() - self.idle_timeout
+        for key in list(self.idle):
+            fresh = []
+            for sock, idle_since in self.idle[key]:
+                if idle_since >= deadline:
+                    fresh.append((sock, idle_since))
+                else:
+                    sock.close()
+            if fresh:
+                self.idle[key] = fresh
+            else:
+                del self.idle[key]
+
+    def close_all(self):
+        for key in list(self.idle):
+            self.evict(key)
+
+class UpstreamBalancer:
+    """Spreads client connections over several upstream proxies and benches failing ones"""
+    STRATEGIES = ('least_conn', 'round_robin')
+
+    def __init__(self, strategy='least_conn', sticky=False, sticky_ttl=600,
+                 max_failures=3, quarantine=60):
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Unknown balancing strategy: {strategy}")
+        self.strategy = strategy
+        self.sticky = sticky
+        self.sticky_ttl = sticky_ttl
+        self.max_failures = max_failures
+        self.quarantine = quarantine
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.affinity = {}
+        self.leases = {}
+
+    @staticmethod
+    def default_weight(proxy):
+        # Faster proxies take proportionally more connections, within 1..10
+        return max(1, min(10, round(1000 / max(proxy.get('latency', 1000), 100))))
+
+    def set_upstreams(self, proxies):
+        """Replace the upstream set, keeping counters for proxies that stay"""
+        with self.lock:
+            entries = OrderedDict()
+            for proxy in proxies:
+                key = proxy_key(proxy)
+                entry = self.entries.get(key) or {
+                    'active': 0, 'served': 0, 'failures': 0, 'down_until': 0, 'current': 0
+                }
+                entry['proxy'] = proxy
+                entry['weight'] = proxy.get('weight') or self.default_weight(proxy)
+                entries[key] = entry
+            self.entries = entries
+            self.affinity = {dest: pin for dest, pin in self.affinity.items() if pin[0] in entries}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def upstreams(self):
+        with self.lock:
+            return [entry['proxy'] for entry in self.entries.values()]
+
+    def pick(self, destination=None, exclude=(), protocols=None):
+        """Upstream for a new connection to destination, or None if there are none
+
+        exclude holds keys that already failed this request; they are only
+        retried when nothing else is configured. protocols, if given, limits
+        the pick to upstreams speaking one of them.
+        """
+        now = time.time()
+        with self.lock:
+            entries = [(key, entry) for key, entry in self.entries.items()
+                       if protocols is None or entry['proxy']['protocol'] in protocols]
+            if not entries:
+                return None
+            candidates = [(key, entry) for key, entry in entries if key not in exclude] or entries
+            healthy = [(key, entry) for key, entry in candidates if entry['down_until'] <= now]
+            if not healthy:
+                # Everything is benched; try whichever comes back soonest rather than refuse
+                healthy = [min(candidates, key=lambda item: item[1]['down_until'])]
+            if self.sticky and destination:
+                pinned = self.affinity.get(destination)
+                if pinned and pinned[1] > now and pinned[0] not in exclude:
+                    entry = self.entries.get(pinned[0])
+                    if (entry and entry['down_until'] <= now
+                            and (protocols is None or entry['proxy']['protocol'] in protocols)):
+                        return entry['proxy']
+            if self.strategy == 'least_conn':
+                key, entry = min(healthy, key=lambda item: (item[1]['active'] / item[1]['weight'], item[1]['served']))
+            else:
+                # Smooth weighted round robin: interleaves picks instead of bursting
+                total = 0
+                for _, candidate in healthy:
+                    candidate['current'] += candidate['weight']
+                    total += candidate['weight']
+                key, entry = max(healthy, key=lambda item: item[1]['current'])
+                entry['current'] -= total
+            entry['served'] += 1
+            if self.sticky and destination:
+                self.affinity[destination] = (key, now + self.sticky_ttl)
+            return entry['proxy']
+
+    def lease(self, proxy, sock):
+        """Count sock as an outstanding connection on proxy until released"""
+        key = proxy_key(proxy)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                entry['active'] += 1
+                self.leases[sock] = key
+
+    def release(self, sock):
+        with self.lock:
+            key = self.leases.pop(sock, None)
+            entry = self.entries.get(key)
+            if entry:
+                entry['active'] -= 1
+
+    def report(self, proxy, ok):
+        """Record a connect outcome; consecutive failures bench the upstream"""
+        key = proxy_key(proxy)
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return
+            if ok:
+                entry['failures'] = 0
+                return
+            entry['failures'] += 1
+            if entry['failures'] >= self.max_failures:
+                self._bench(key, entry)
+
+    def mark_down(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self._bench(key, entry)
+
+    def _bench(self, key, entry):
+        entry['down_until'] = time.time() + self.quarantine
+        entry['failures'] = 0
+        self.affinity = {dest: pin for dest, pin in self.affinity.items() if pin[0] != key}
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            return [{
+                'upstream': f"{key[2]}://{key[0]}:{key[1]}",
+                'weight': entry['weight'],
+                'active': entry['active'],
+                'served': entry['served'],
+                'healthy': entry['down_until'] <= now
+            } for key, entry in self.entries.items()]
+
+class RelayBufferPool:
+    """Bounded set of reusable relay buffers shared by all connections on one loop
+
+    A buffer is held only while one chunk is received and sent, never while a
+    connection sits idle, so max_buffers bounds concurrent copies, not tunnels.
+    """
+    def __init__(self, buffer_size=65536, max_buffers=256):
+        self.buffer_size = buffer_size
+        self.max_buffers = max_buffers
+        self.free = []
+        self.slots = None
+
+    async def acquire(self):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_buffers)
+        await self.slots.acquire()
+        return self.free.pop() if self.free else bytearray(self.buffer_size)
+
+    def release(self, buffer):
+        self.free.append(buffer)
+        self.slots.release()
+
+SPLICE_AVAILABLE = hasattr(os, 'splice') and sys.platform.startswith('linux')
+
+class LocalForwarder:
+    """Fixed HTTP CONNECT + SOCKS5 endpoint relaying clients to the current upstream proxy"""
+    def __init__(self, host=LOCAL_PROXY_HOST, port=LOCAL_PROXY_PORT, timeout=10,
+                 zero_copy=True, buffer_size=65536, max_buffers=256,
+                 idle_timeout=30, max_per_host=8, prewarm=1, balance='least_conn', sticky=False,
+                 max_failures=3, quarantine=60):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.zero_copy = zero_copy and SPLICE_AVAILABLE
+        self.buffers = RelayBufferPool(buffer_size, max_buffers)
+        self.pool = UpstreamPool(idle_timeout, max_per_host)
+        self.prewarm = prewarm
+        self.balancer = UpstreamBalancer(balance, sticky, max_failures=max_failures, quarantine=quarantine)
+        self.loop = None
+        self.thread = None
+        self.server_sock = None
+        self.main_task = None
+        self.clients = set()
+        self.stats = {'connections': 0, 'active': 0, 'sent': 0, 'received': 0, 'errors': 0}
+
+    def set_upstream(self, proxy):
+        """Switch upstream for new connections; open tunnels keep the one they started with"""
+        self.balancer.set_upstreams([proxy] if proxy else [])
+
+    def set_upstreams(self, proxies):
+        """Balance new connections across several upstreams"""
+        self.balancer.set_upstreams(proxies)
+
+    def mark_dead(self, proxy):
+        """Evict pooled connections to an upstream and bench it (safe to call from any thread)"""
+        key = proxy_key(proxy)
+        self.balancer.mark_down(key)
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.pool.evict, key)
+
+    def start(self):
+        """Bind the listening socket and serve on a background event loop"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((self.host, self.port))
+            sock.listen(128)
+        except OSError:
+            sock.close()
+            raise
+        sock.setblocking(False)
+        self.server_sock = sock
+        ready = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.main_task = self.loop.create_task(self._serve())
+            self.loop.call_soon(ready.set)
+            try:
+                self.loop.run_until_complete(self.main_task)
+            except asyncio.CancelledError:
+                pass
+            finally:
+                self.loop.close()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        ready.wait(5)
+
+    def stop(self):
+        """Close the listener and every open tunnel"""
+        if self.loop and self.main_task and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.main_task.cancel)
+        if self.thread and self.thread.is_alive():
+            self.thread.join(timeout=5)
+        self.thread = None
+
+    async def _reap_idle(self):
+        while True:
+            await asyncio.sleep(max(1, self.pool.idle_timeout / 2))
+            self.pool.reap()
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        reaper = loop.create_task(self._reap_idle())
+        try:
+            while True:
+                client, _ = await loop.sock_accept(self.server_sock)
+                client.setblocking(False)
+                task = loop.create_task(self._handle(client))
+                self.clients.add(task)
+                task.add_done_callback(self.clients.discard)
+        finally:
+            reaper.cancel()
+            self.pool.close_all()
+            self.server_sock.close()
+            for task in list(self.clients):
+                task.cancel()
+            if self.clients:
+                await asyncio.gather(*self.clients, return_exceptions=True)
+
+    async def _handle(self, client):
+        upstream_sock = None
+        self.stats['connections'] += 1
+        self.stats['active'] += 1
+        try:
+            buffer = _SocketBuffer(client)
+            await buffer.fill()
+            if buffer.data[0] == 5:
+                upstream_sock = await self._accept_socks5(buffer)
+            else:
+                upstream_sock = await self._accept_http(buffer)
+            if upstream_sock:
+                await self._relay(client, upstream_sock)
+        except (OSError, ConnectionError, asyncio.TimeoutError, ValueError, IndexError):
+            self.stats['errors'] += 1
+        finally:
+            self.stats['active'] -= 1
+            client.close()
+            if upstream_sock:
+                self.balancer.release(upstream_sock)
+                upstream_sock.close()
+
+    async def _connect_upstream(self, host, port, proxy=None):
+        """Tunnel to host:port through the given upstream or the balancer's pick"""
+        # Nothing has been sent to the client yet, so a balanced tunnel may fail over once
+        forced = proxy
+        attempts = 1 if forced else min(2, max(1, len(self.balancer)))
+        failed = set()
+        for attempt in range(attempts):
+            proxy = forced or self.balancer.pick(host, exclude=failed)
+            if not proxy:
+                raise ConnectionError("No upstream proxy selected")
+            try:
+                sock, _ = await self.pool.acquire(proxy, self.timeout)
+                try:
+                    leftover = await asyncio.wait_for(proxy_handshake(sock, proxy, host, port), self.timeout)
+                except BaseException:
+                    sock.close()
+                    raise
+                break
+            except (OSError, ConnectionError, asyncio.TimeoutError):
+                failed.add(proxy_key(proxy))
+                self.pool.evict(proxy_key(proxy))
+                self.balancer.report(proxy, False)
+                if attempt == attempts - 1:
+                    raise
+        self.balancer.report(proxy, True)
+        self.balancer.lease(proxy, sock)
+        if self.prewarm:
+            asyncio.get_running_loop().create_task(self.pool.prewarm(proxy, self.prewarm, self.timeout))
+        return sock, leftover
+
+    async def _accept_socks5(self, buffer):
+        loop = asyncio.get_running_loop()
+        client = buffer.sock
+        _, method_count = await buffer.read_exact(2)
+        await buffer.read_exact(method_count)
+        await loop.sock_sendall(client, b'\x05\x00')
+
+        version, command, _, address_type = await buffer.read_exact(4)
+        if address_type == 1:
+            host = socket.inet_ntoa(await buffer.read_exact(4))
+        elif address_type == 4:
+            host = socket.inet_ntop(socket.AF_INET6, await buffer.read_exact(16))
+        else:
+            length = (await buffer.read_exact(1))[0]
+            host = (await buffer.read_exact(length)).decode('idna')
+        port = struct.unpack('!H', await buffer.read_exact(2))[0]
+        if command != 1:
+            await loop.sock_sendall(client, b'\x05\x07\x00\x01' + bytes(6))
+            return None
+
+        try:
+            upstream, leftover = await self._connect_upstream(host, port)
+        except (OSError, ConnectionError, asyncio.TimeoutError):
+            await loop.sock_sendall(client, b'\x05\x01\x00\x01' + bytes(6))
+            raise
+        await loop.sock_sendall(client, b'\x05\x00\x00\x01' + bytes(6))
+        await self._flush_pending(client, upstream, buffer.drain(), leftover)
+        return upstream
+
+    async def _accept_http(self, buffer):
+        """Serve HTTP requests, returning an upstream socket if the rest should be relayed raw"""
+        loop = asyncio.get_running_loop()
+        client = buffer.sock
+        while True:
+            head = await buffer.read_until(b'\r\n\r\n')
+            method, target, version = head.split(b'\r\n', 1)[0].split(b' ', 2)
+            if method.upper() == b'CONNECT':
+                return await self._accept_connect(buffer, target)
+
+            headers = _header_map(head)
+            destination = urlparse('//' + headers.get(b'host', b'').decode('latin-1')).hostname
+            proxy = self.balancer.pick(destination)
+            if not proxy:
+                await loop.sock_sendall(client, b'HTTP/1.1 503 Service Unavailable\r\nConnection: close\r\n\r\n')
+                return None
+            body_length = int(headers.get(b'content-length', b'0') or 0)
+            if (proxy['protocol'] not in ('http', 'https') or b'transfer-encoding' in headers
+                    or b'upgrade' in headers or b'expect' in headers or body_length > 1 << 20):
+                return await self._forward_raw(buffer, head, proxy)
+            if not await self._forward_pooled(buffer, head, method.upper(), version, headers, proxy,
+                                              body_length, destination):
+                return None
+            if await buffer.at_eof():
+                return None
+
+    async def _accept_connect(self, buffer, target):
+        loop = asyncio.get_running_loop()
+        client = buffer.sock
+        host, _, port = target.decode('latin-1').rpartition(':')
+        try:
+            upstream, leftover = await self._connect_upstream(host.strip('[]'), int(port))
+        except (OSError, ConnectionError, asyncio.TimeoutError):
+            await loop.sock_sendall(client, b'HTTP/1.1 502 Bad Gateway\r\nConnection: close\r\n\r\n')
+            raise
+        await loop.sock_sendall(client, b'HTTP/1.1 200 Connection established\r\n\r\n')
+        await self._flush_pending(client, upstream, buffer.drain(), leftover)
+        return upstream
+
+    async def _forward_raw(self, buffer, head, proxy):
+        """One request per connection; the caller relays everything after the head"""
+        loop = asyncio.get_running_loop()
+        client = buffer.sock
+        target = head.split(b'\r\n', 1)[0].split(b' ', 2)[1]
+        parsed = urlparse(target.decode('latin-1'))
+        try:
+            if proxy['protocol'] in ('http', 'https'):
+                upstream, _ = await self.pool.acquire(proxy, self.timeout)
+                self.balancer.lease(proxy, upstream)
+                request = _rewrite_request_head(head, origin_form=False)
+            else:
+                upstream, _ = await self._connect_upstream(parsed.hostname, parsed.port or 80, proxy)
+                request = _rewrite_request_head(head, origin_form=True)
+        except (OSError, ConnectionError, asyncio.TimeoutError):
+            self.pool.evict(proxy_key(proxy))
+            self.balancer.report(proxy, False)
+            await loop.sock_sendall(client, b'HTTP/1.1 502 Bad Gateway\r\nConnection: close\r\n\r\n')
+            raise
+        await loop.sock_sendall(upstream, request + buffer.drain())
+        return upstream
+
+    async def _forward_pooled(self, buffer, head, method, version, headers, proxy, body_length, destination=None):
+        """Send one request over a keep-alive upstream connection; True if the client may send another"""
+        loop = asyncio.get_running_loop()
+        client = buffer.sock
+        request = _rewrite_request_head(head, origin_form=False, keep_alive=True)
+        body = await buffer.read_exact(body_length) if body_length else b''
+
+        for attempt in (0, 1):
+            upstream = None
+            try:
+                upstream, reused = await self.pool.acquire(proxy, self.timeout)
+                response = _SocketBuffer(upstream)
+                await loop.sock_sendall(upstream, request + body)
+                response_head = await asyncio.wait_for(response.read_until(b'\r\n\r\n'), self.timeout)
+                while response_head.split(b' ', 2)[1] == b'100':
+                    response_head = await asyncio.wait_for(response.read_until(b'\r\n\r\n'), self.timeout)
+                break
+            except (OSError, ConnectionError, asyncio.TimeoutError, IndexError):
+                if upstream:
+                    upstream.close()
+                    # A parked connection may have been closed by the proxy; retry once on a fresh one
+                    if reused and attempt == 0 and method in IDEMPOTENT_METHODS:
+                        continue
+                self.pool.evict(proxy_key(proxy))
+                self.balancer.report(proxy, False)
+                # The request never left, so it can go to another upstream whatever its method
+                if upstream is None and attempt == 0 and len(self.balancer) > 1:
+                    # Skip the failed upstream even if destination is pinned to it; the request
+                    # is already in absolute form, so only another HTTP upstream can take it
+                    failover = self.balancer.pick(destination, exclude={proxy_key(proxy)},
+                                                  protocols=('http', 'https'))
+                    if failover and proxy_key(failover) != proxy_key(proxy):
+                        proxy = failover
+                        continue
+                await loop.sock_sendall(client, b'HTTP/1.1 502 Bad Gateway\r\nConnection: close\r\n\r\n')
+                raise
+
+        self.balancer.report(proxy, True)
+        self.balancer.lease(proxy, upstream)
+        try:
+            return await self._finish_pooled(buffer, upstream, response, response_head,
+                                             method, version, headers, proxy, len(request) + len(body))
+        finally:
+            self.balancer.release(upstream)
+
+    async def _finish_pooled(self, buffer, upstream, response, response_head,
+                             method, version, headers, proxy, sent):
+        """Relay a pooled response to the client and park the upstream if it can be reused"""
+        loop = asyncio.get_running_loop()
+        client = buffer.sock
+        response_version, status = response_head.split(b' ', 2)[:2]
+        response_headers = _header_map(response_head)
+        if method == b'HEAD' or status in (b'204', b'304') or status.startswith(b'1'):
+            length = 0
+        elif b'chunked' in response_headers.get(b'transfer-encoding', b'').lower():
+            length = 'chunked'
+        elif response_headers.get(b'content-length', b'').isdigit():
+            length = int(response_headers[b'content-length'])
+        else:
+            length = None
+        upstream_keep = length is not None and _wants_keep_alive(response_version, response_headers)
+        client_keep = length is not None and _wants_keep_alive(version, headers)
+
+        try:
+            await loop.sock_sendall(client, _rewrite_response_head(response_head, client_keep))
+            if length == 'chunked':
+                await self._relay_chunked(response, client)
+            elif length is None:
+                await loop.sock_sendall(client, response.drain())
+                await self._pipe(upstream, client, 'received')
+            else:
+                await self._relay_exact(response, client, length)
+        except BaseException:
+            upstream.close()
+            raise
+        self.stats['sent'] += sent
+
+        if upstream_keep and not response.data:
+            self.pool.release(proxy, upstream)
+        else:
+            upstream.close()
+        return client_keep
+
+    async def _relay_exact(self, source, destination, size):
+        """Forward exactly size bytes from a buffered socket"""
+        loop = asyncio.get_running_loop()
+        head = source.data[:size]
+        source.data = source.data[size:]
+        if head:
+            await loop.sock_sendall(destination, head)
+        remaining = size - len(head)
+        self.stats['received'] += len(head)
+        if not remaining:
+            return
+        while remaining:
+            received = await self._copy_chunk(source.sock, destination, remaining)
+            if received is None:
+                continue
+            if not received:
+                raise ConnectionError("Upstream closed mid-body")
+            remaining -= received
+            self.stats['received'] += received
+
+    async def _relay_chunked(self, source, destination):
+        """Forward a chunked body up to and including its trailers"""
+        loop = asyncio.get_running_loop()
+        while True:
+            line = await source.read_until(b'\r\n')
+            await loop.sock_sendall(destination, line + b'\r\n')
+            size = int(line.split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                while True:
+                    trailer = await source.read_until(b'\r\n')
+                    await loop.sock_sendall(destination, trailer + b'\r\n')
+                    if not trailer:
+                        return
+            await self._relay_exact(source, destination, size + 2)
+
+    async def _flush_pending(self, client, upstream, to_upstream, to_client):
+        """Forward bytes that arrived alongside the handshake"""
+        loop = asyncio.get_running_loop()
+        if to_upstream:
+            await loop.sock_sendall(upstream, to_upstream)
+        if to_client:
+            await loop.sock_sendall(client, to_client)
+
+    async def _wait_fd(self, fd, writable=False):
+        """Suspend until fd is readable (or writable)"""
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        add, remove = (loop.add_writer, loop.remove_writer) if writable else (loop.add_reader, loop.remove_reader)
+        add(fd, lambda: waiter.done() or waiter.set_result(None))
+        try:
+            await waiter
+        finally:
+            remove(fd)
+
+    async def _pipe_splice(self, source, destination, counter):
+        """Move bytes socket -> pipe -> socket inside the kernel"""
+        read_end, write_end = os.pipe()
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        src, dst = source.fileno(), destination.fileno()
+        chunk = self.buffers.buffer_size
+        try:
+            while True:
+                try:
+                    moved = os.splice(src, write_end, chunk, flags=flags)
+                except BlockingIOError:
+                    await self._wait_fd(src)
+                    continue
+                if not moved:
+                    break
+                pending = moved
+                while pending:
+                    try:
+                        pending -= os.splice(read_end, dst, pending, flags=flags)
+                    except BlockingIOError:
+                        await self._wait_fd(dst, writable=True)
+                self.stats[counter] += moved
+        finally:
+            os.close(read_end)
+            os.close(write_end)
+
+    async def _copy_chunk(self, source, destination, limit=None):
+        """Wait for data, then move one chunk through a buffer borrowed just for that chunk
+
+        Returns the byte count, 0 at EOF, or None if the wakeup found nothing to read.
+        """
+        loop = asyncio.get_running_loop()
+        await self._wait_fd(source.fileno())
+        buffer = await self.buffers.acquire()
+        view = memoryview(buffer)
+        try:
+            try:
+                received = source.recv_into(buffer, min(limit or len(buffer), len(buffer)))
+            except (BlockingIOError, InterruptedError):
+                return None
+            if received:
+                await loop.sock_sendall(destination, view[:received])
+            return received
+        finally:
+            view.release()
+            self.buffers.release(buffer)
+
+    async def _pipe_copy(self, source, destination, counter):
+        """Relay through pooled buffers without per-read allocations"""
+        while True:
+            received = await self._copy_chunk(source, destination)
+            if received is None:
+                continue
+            if not received:
+                break
+            self.stats[counter] += received
+
+    async def _pipe(self, source, destination, counter):
+        try:
+            if self.zero_copy:
+                try:
+                    await self._pipe_splice(source, destination, counter)
+                    return
+                except OSError as e:
+                    # EINVAL/ENOSYS: this kernel or socket type can't splice
+                    if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                        raise
+                    self.zero_copy = False
+            await self._pipe_copy(source, destination, counter)
+        finally:
+            try:
+                destination.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    async def _relay(self, client, upstream):
+        """Copy bytes both ways until each side has closed"""
+        results = await asyncio.gather(
+            self._pipe(client, upstream, 'sent'),
+            self._pipe(upstream, client, 'received'),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, asyncio.CancelledError):
+                raise result
+
+def benchmark_relay(size_mb=256, zero_copy=True):
+    """Push size_mb through LocalForwarder's relay over loopback and report MB/s per core"""
+    forwarder = LocalForwarder(zero_copy=zero_copy)
+    total = size_mb * 1024 * 1024
+    listener = socket.create_server(('127.0.0.1', 0))
+    address = listener.getsockname()
+
+    def tcp_pair():
+        outer = socket.create_connection(address)
+        inner, _ = listener.accept()
+        inner.setblocking(False)
+        return outer, inner
+
+    source, relay_in = tcp_pair()
+    sink, relay_out = tcp_pair()
+    listener.close()
+
+    def produce():
+        block = b'\0' * 65536
+        sent = 0
+        while sent < total:
+            sent += source.send(block[:total - sent])
+        source.shutdown(socket.SHUT_WR)
+
+    received = [0]
+
+    def consume():
+        buffer = bytearray(65536)
+        while True:
+            count = sink.recv_into(buffer)
+            if not count:
+                break
+            received[0] += count
+
+    async def run():
+        start = time.thread_time()
+        await asyncio.gather(
+            forwarder._pipe(relay_in, relay_out, 'sent'),
+            forwarder._pipe(relay_out, relay_in, 'received')
+        )
+        return time.thread_time() - start
+
+    workers = [threading.Thread(target=produce), threading.Thread(target=consume)]
+    for worker in workers:
+        worker.start()
+    wall_start = time.time()
+    # Closing the sink direction lets the reverse pipe finish once data is through
+    sink.shutdown(socket.SHUT_WR)
+    cpu = asyncio.run(run())
+    wall = time.time() - wall_start
+    for worker in workers:
+        worker.join()
+    for sock in (source, sink, relay_in, relay_out):
+        sock.close()
+
+    mode = "splice" if forwarder.zero_copy else "recv_into"
+    megabytes = received[0] / (1024 * 1024)
+    print(f"📦 Relay benchmark ({mode}): {megabytes:.0f} MB in {wall:.2f}s")
+    print(f"   Throughput: {megabytes / wall:.1f} MB/s | Relay CPU: {cpu:.2f}s | {megabytes / max(cpu, 1e-6):.1f} MB/s per core")
+    return megabytes / max(cpu, 1e-6)
+
+# ===== JOB SCHEDULER =====
+SCHEDULE_PERIODS = {'minutely': 60, 'hourly': 3600, 'daily': 86400, 'weekly': 604800}
+SCHEDULE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+def parse_schedule(spec):
+    """Turn a schedule spec into (interval_seconds, first_run_timestamp or None)
+
+    Accepts seconds as a number, intervals like '90s', '15m', '2h', '1d', and the
+    calendar specs 'hourly', 'daily', 'weekly' (optionally 'daily@03:30' or
+    'hourly@30'), which fire on local clock boundaries like cron.
+    """
+    if isinstance(spec, (int, float)):
+        if spec <= 0:
+            raise ValueError("Schedule interval must be positive")
+        return float(spec), None
+    spec = spec.strip().lower()
+    name = spec.partition('@')[0]
+    if name in SCHEDULE_PERIODS:
+        return float(SCHEDULE_PERIODS[name]), next_boundary(spec)
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([smhd]?)', spec)
+    if not match or float(match.group(1)) <= 0:
+        raise ValueError(f"Unknown schedule: {spec}")
+    return float(match.group(1)) * SCHEDULE_UNITS[match.group(2) or 's'], None
+
+def next_boundary(spec, after=None):
+    """First local clock boundary of a calendar spec strictly after `after` (default: now)
+
+    Works on naive local datetimes, so 'daily@03:30' stays at 03:30 across DST
+    changes instead of drifting by the hour a fixed 86400s step would.
+    """
+    name, _, at = spec.strip().lower().partition('@')
+    try:
+        parts = [int(part) for part in at.split(':')] if at else []
+    except ValueError:
+        parts = None
+    if parts and name == 'hourly' and len(parts) == 1:
+        # 'hourly@30' is a bare minute past the hour
+        parts = [0] + parts
+    if parts is None or (parts and len(parts) != 2):
+        raise ValueError(f"Bad time in schedule {spec!r}: expected HH:MM")
+    hour, minute = parts or (0, 0)
+    now = datetime.fromtimestamp(time.time() if after is None else after)
+    if name == 'minutely':
+        first = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    elif name == 'hourly':
+        first = now.replace(minute=minute if at else 0, second=0, microsecond=0)
+    else:
+        first = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if name == 'weekly':
+            first -= timedelta(days=first.weekday())
+    while first <= now:
+        first += timedelta(seconds=SCHEDULE_PERIODS[name])
+    return first.timestamp()
+
+class ScheduledJob:
+    """A periodic job; its callable may return a number of seconds to override the next delay"""
+    CATCH_UP = ('skip', 'all', 'delay')
+
+    def __init__(self, name, func, interval, next_run, catch_up='skip', until=None, on_finish=None,
+                 calendar=None):
+        if catch_up not in self.CATCH_UP:
+            raise ValueError(f"Unknown catch-up policy: {catch_up}")
+        self.name = name
+        self.func = func
+        self.interval = interval
+        # For calendar specs: maps a timestamp to the next clock boundary after it
+        self.calendar = calendar
+        self.next_run = next_run
+        self.catch_up = catch_up
+        self.until = until
+        self.on_finish = on_finish
+        self.cancelled = False
+        self.running = False
+        self.runs = 0
+        self.missed = 0
+        self.last_run = None
+
+    def __lt__(self, other):
+        return self.next_run < other.next_run
+
+    def reschedule(self, now, override=None):
+        """Pick the next run time according to the catch-up policy"""
+        if override is not None:
+            self.next_run = now + override
+        elif self.calendar:
+            self._reschedule_calendar(now)
+        elif self.catch_up == 'delay':
+            self.next_run = now + self.interval
+        elif self.catch_up == 'all':
+            # Replay missed runs back to back, but never more than ten of them
+            self.next_run = max(self.next_run + self.interval, now - 10 * self.interval)
+        else:
+            # Stay on the original grid and drop the runs that were missed
+            skipped = max(0, int((now - self.next_run) // self.interval))
+            self.missed += skipped
+            self.next_run += (skipped + 1) * self.interval
+
+    def _reschedule_calendar(self, now):
+        """Same policies as reschedule, stepping boundary to boundary in local time"""
+        if self.catch_up == 'delay':
+            self.next_run = self.calendar(now)
+            return
+        next_run = self.calendar(self.next_run)
+        if self.catch_up == 'all':
+            self.next_run = max(next_run, self.calendar(now - 10 * self.interval))
+            return
+        while next_run <= now:
+            self.missed += 1
+            next_run = self.calendar(next_run)
+        self.next_run = next_run
+
+    def describe(self):
+        return {
+            'name': self.name,
+            'interval': self.interval,
+            'next_run': datetime.fromtimestamp(self.next_run).isoformat(timespec='seconds'),
+            'runs': self.runs,
+            'missed': self.missed
+        }
+
+class Scheduler:
+    """Runs every periodic job from one heap on one timer thread
+
+    The timer thread only waits and dispatches; jobs run on a worker pool that
+    grows to one thread per job, so a slow rotation never delays a one-second
+    monitor tick. A job that is still running when it comes due again counts as
+    missed instead of overlapping.
+    """
+    def __init__(self, workers=2, log=None):
+        self.log = log or (lambda message: None)
+        self.heap = []
+        self.jobs = {}
+        self.condition = threading.Condition()
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            for job in self.jobs.values():
+                job.cancelled = True
+            self.jobs.clear()
+            self.heap.clear()
+            self.condition.notify()
+        if self.thread and self.thread.is_alive():
+            self.thread.join(timeout=2)
+        self.executor.shutdown(wait=False)
+
+    def every(self, spec, func, name=None, first_run=None, catch_up='skip', until=None, on_finish=None):
+        """Run func on a schedule; a job with the same name is replaced
+
+        first_run is a delay in seconds (0 runs at once); by default the first run
+        is one interval away, or the next clock boundary for calendar specs.
+        """
+        interval, boundary = parse_schedule(spec)
+        now = time.time()
+        if first_run is not None:
+            next_run = now + first_run
+        else:
+            next_run = boundary or now + interval
+        calendar = (lambda after: next_boundary(spec, after)) if boundary else None
+        job = ScheduledJob(name or getattr(func, '__name__', 'job'), func, interval,
+                           next_run, catch_up, until, on_finish, calendar)
+        with self.condition:
+            previous = self.jobs.get(job.name)
+            if previous:
+                previous.cancelled = True
+            self.jobs[job.name] = job
+            self._grow_workers()
+            heapq.heappush(self.heap, job)
+            self.condition.notify()
+        self.start()
+        return job
+
+    def _grow_workers(self):
+        """Keep a worker per job plus one for on_finish hooks (called with the condition held)
+
+        Jobs never overlap themselves, so this many workers means a due job is
+        never queued behind another one. Threads start lazily, so idle slots are free.
+        """
+        needed = len(self.jobs) + 1
+        if needed <= self.workers:
+            return
+        self.workers = needed
+        # Work already submitted to the old pool still runs; new work goes to the bigger one
+        previous, self.executor = self.executor, ThreadPoolExecutor(max_workers=needed,
+                                                                    thread_name_prefix='job')
+        previous.shutdown(wait=False)
+
+    def cancel(self, name):
+        """Cancel a job by name; takes effect immediately, even mid-wait"""
+        with self.condition:
+            job = self.jobs.pop(name, None)
+            if not job:
+                return False
+            job.cancelled = True
+            self.condition.notify()
+        return True
+
+    def get(self, name):
+        return self.jobs.get(name)
+
+    def describe(self):
+        with self.condition:
+            return [job.describe() for job in sorted(self.jobs.values())]
+
+    def run(self):
+        with self.condition:
+            while self.running:
+                while self.heap and self.heap[0].cancelled:
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                delay = self.heap[0].next_run - time.time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                job = heapq.heappop(self.heap)
+                now = time.time()
+                if job.until and now >= job.until:
+                    self._finish(job)
+                    continue
+                if job.running:
+                    job.missed += 1
+                    job.reschedule(now)
+                    heapq.heappush(self.heap, job)
+                    continue
+                job.running = True
+                self.executor.submit(self._execute, job)
+
+    def _execute(self, job):
+        override = None
+        try:
+            result = job.func()
+            # bool is an int, so only plain numbers count as a delay override
+            if isinstance(result, (int, float)) and not isinstance(result, bool):
+                override = result
+        except Exception as e:
+            self.log(f"Scheduled job {job.name} failed: {str(e)}")
+        with self.condition:
+            job.running = False
+            job.runs += 1
+            job.last_run = time.time()
+            if job.cancelled or not self.running:
+                return
+            job.reschedule(job.last_run, override)
+            if job.until and job.next_run >= job.until:
+                self._finish(job)
+                return
+            heapq.heappush(self.heap, job)
+            self.condition.notify()
+
+    def _finish(self, job):
+        """Retire a job whose `until` has passed (called with the condition held)"""
+        if self.jobs.get(job.name) is job:
+            del self.jobs[job.name]
+        job.cancelled = True
+        if job.on_finish:
+            self.executor.submit(job.on_finish)
+
+# ===== DAEMON CONTROL API =====
+class ControlServer:
+    """Unix-socket control API: one JSON object per line in, one JSON reply per line out"""
+    def __init__(self, handlers, path=CONTROL_SOCKET, log=None):
+        self.handlers = handlers
+        self.path = path
+        self.log = log or (lambda message: None)
+        self.server = None
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        if os.path.exists(self.path):
+            # A live daemon answers on the socket; a stale file is left by a crash
+            try:
+                control_request('ping', path=self.path, timeout=1)
+                raise RuntimeError(f"another daemon is listening on {self.path}")
+            except (ConnectionError, FileNotFoundError, socket.timeout):
+                os.unlink(self.path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Create the socket owner-only; a chmod after bind leaves a window where anyone can connect
+        old_umask = os.umask(0o177)
+        try:
+            self.server.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        self.server.listen(16)
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.server:
+            try:
+                self.server.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.server.close()
+            self.server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def serve(self):
+        while self.running:
+            try:
+                client, _ = self.server.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.handle_client, args=(client,), daemon=True).start()
+
+    def handle_client(self, client):
+        with client, client.makefile('rwb') as stream:
+            for line in stream:
+                if not line.strip():
+                    continue
+                stream.write(json.dumps(self.dispatch(line)).encode() + b"\n")
+                stream.flush()
+
+    def dispatch(self, line):
+        try:
+            request = json.loads(line)
+            command = request.pop('cmd')
+            handler = self.handlers.get(command)
+            if not handler:
+                return {'ok': False, 'error': f"unknown command: {command}",
+                        'commands': sorted(self.handlers)}
+            return {'ok': True, 'result': handler(**request)}
+        except Exception as e:
+            self.log(f"Control command failed: {str(e)}")
+            return {'ok': False, 'error': str(e)}
+
+def control_request(command, path=CONTROL_SOCKET, timeout=30, **args):
+    """Send one command to a running daemon and return its decoded reply"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(path)
+        client.sendall(json.dumps({'cmd': command, **args}).encode() + b"\n")
+        with client.makefile('rb') as stream:
+            reply = stream.readline()
+    if not reply:
+        raise ConnectionError("daemon closed the connection without replying")
+    return json.loads(reply)
+
+# ===== STRUCTURED LOGGER =====
+class JsonLogger:
+    """JSON-lines log written by a single background thread
+
+    log() only stamps the record and enqueues it, so rotation and validator
+    threads never wait on the disk; if the queue is full the record is dropped
+    and counted. The writer keeps the file open, writes whatever has queued up
+    as one batch and flushes once per batch. When the day changes the file is
+    renamed to <archive_dir>/<prefix>_YYYYMMDD.log and a fresh one is opened.
+    """
+    def __init__(self, path=LOG_FILE, archive_dir="logs", prefix="proxy", max_queue=10000,
+                 batch_size=512, flush_interval=1.0):
+        self.path = path
+        self.archive_dir = archive_dir
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        # Many threads may overflow the queue at once; += on an attribute is not atomic
+        self.dropped_lock = threading.Lock()
+        self.file = None
+        self.day = None
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name='log-writer', daemon=True)
+        self.thread.start()
+
+    def log(self, message, level='info', **fields):
+        """Queue one record; never blocks"""
+        if self.stopped:
+            return
+        try:
+            self.queue.put_nowait((time.time(), level, message, fields))
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+
+    def close(self, timeout=5):
+        """Write out what is queued and stop the writer"""
+        if self.stopped:
+            return
+        self.stopped = True
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    def run(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            done = None in batch
+            try:
+                self.write([record for record in batch if record is not None])
+            except OSError as e:
+                print(f"⚠️ Log write failed: {str(e)}", file=sys.stderr)
+            if done:
+                if self.file:
+                    self.file.close()
+                return
+
+    def write(self, records):
+        if not records:
+            return
+        lines = []
+        for ts, level, message, fields in records:
+            day = time.strftime('%Y%m%d', time.localtime(ts))
+            if day != self.day:
+                self.flush_lines(lines)
+                lines = []
+                self.open_for(day)
+            entry = {
+                'ts': datetime.fromtimestamp(ts).isoformat(timespec='milliseconds'),
+                'level': level,
+                'msg': message,
+                **fields
+            }
+            lines.append(json.dumps(entry, default=str))
+        with self.dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            lines.append(json.dumps({
+                'ts': datetime.now().isoformat(timespec='milliseconds'),
+                'level': 'warning',
+                'msg': f"Log queue full, dropped {dropped} records"
+            }))
+        self.flush_lines(lines)
+
+    def flush_lines(self, lines):
+        if lines:
+            self.file.write("\n".join(lines) + "\n")
+            self.file.flush()
+
+    def open_for(self, day):
+        """Point the writer at today's file, archiving the previous day's by rename"""
+        if self.file:
+            self.file.close()
+            self.rotate(self.day)
+        elif os.path.exists(self.path):
+            # Left over from an earlier run: archive it if it belongs to another day
+            previous = time.strftime('%Y%m%d', time.localtime(os.path.getmtime(self.path)))
+            if previous != day:
+                self.rotate(previous)
+        self.day = day
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def rotate(self, day):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        target = os.path.join(self.archive_dir, f"{self.prefix}_{day}.log")
+        suffix = 1
+        while os.path.exists(target):
+            target = os.path.join(self.archive_dir, f"{self.prefix}_{day}.{suffix}.log")
+            suffix += 1
+        try:
+            os.replace(self.path, target)
+        except FileNotFoundError:
+            pass
+
+# ===== STATE PERSISTENCE =====
+def write_json_atomic(path, data, indent=None):
+    """Write JSON next to path and rename it into place, so a crash never leaves half a file"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+class StateStore:
+    """JSON state files saved on a debounce instead of on every change
+
+    mark(name) only flags the file dirty; the first mark arms a timer and every
+    change made before it fires is written out together by one atomic rewrite.
+    snapshot() is called at write time, so the file holds the latest state.
+    """
+    def __init__(self, delay=2.0, log=None):
+        self.delay = delay
+        self.log = log or (lambda message: None)
+        self.files = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.timer = None
+
+    def register(self, name, path, snapshot, indent=None):
+        self.files[name] = (path, snapshot, indent)
+
+    def mark(self, name):
+        with self.lock:
+            self.dirty.add(name)
+            if self.timer is None:
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        """Write every dirty file now; returns False if any write failed"""
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            names, self.dirty = self.dirty, set()
+        ok = True
+        with self.write_lock:
+            for name in names:
+                path, snapshot, indent = self.files[name]
+                try:
+                    write_json_atomic(path, snapshot(), indent)
+                except Exception as e:
+                    ok = False
+                    self.log(f"Saving {path} failed: {str(e)}")
+                    with self.lock:
+                        self.dirty.add(name)
+        return ok
 
 # ===== ENHANCED TERMUX PROXY MASTER =====
 class TermuxProxyMaster:
     def __init__(self):
-        self.proxies = []
+        self.proxies = ProxyPool()
         self.tor_bridges = []
         self.current_proxy = None
-        self.favorites = []
+        self.favorites = OrderedDict()  # proxy_key -> favorite entry, in the order added
         self.rotation_active = False
-        self.rotation_thread = None
         self.local_proxy_active = False
         self.local_proxy_thread = None
+        self.local_proxy = None
+        self.pinned_proxy = None
+        self.rotate_lock = threading.Lock()
+        self.control_server = None
+        self.daemon_stopped = threading.Event()
+        self.logger = JsonLogger()
+        self.state = StateStore(log=self.log)
+        self.state.register('config', CONFIG_FILE, lambda: dict(self.config), indent=4)
+        self.state.register('favorites', 'favorites.json', lambda: list(self.favorites.values()))
+        self.state.register('history', 'history.json', lambda: list(self.history))
         self.config = {
             "api_url": PROXY_API_URL,
             "max_latency": 2000,
@@ -60,22 +2691,67 @@ class TermuxProxyMaster:
             "kill_switch": False,
             "mac_randomization": False,
             "packet_fragmentation": False,
-            "browser_spoofing": True
+            "browser_spoofing": True,
+            "validator_concurrency": 100,
+            "validator_timeout": 5,
+            "relay_zero_copy": True,
+            "relay_buffer_kb": 64,
+            "relay_max_buffers": 256,
+            "upstream_idle_timeout": 30,
+            "upstream_max_per_host": 8,
+            "upstream_prewarm": 1,
+            "balance_strategy": "least_conn",
+            "balance_sticky": False,
+            "balance_max_failures": 3,
+            "balance_quarantine": 60,
+            "api_pages": 5,
+            "api_page_workers": 4,
+            "max_pool_size": 5000,
+            "warm_pool_size": 5,
+            "standby_ttl": 120,
+            "breaker_base": 30,
+            "breaker_cap": 3600,
+            "exit_ip_ttl": 60,
+            "ip_check_urls": list(IP_CHECK_URLS)
         }
         self.load_config()
         self.setup_directories()
         self.load_favorites()
         self.load_history()
         self.traffic_stats = {"sent": 0, "received": 0}  # Track traffic
+        self.health_store = ProxyHealthStore()
+        # Every fetched page adds rows; drop proxies gone for a week so the store stays bounded
+        pruned = self.health_store.prune()
+        if pruned:
+            self.log(f"Pruned {pruned} stale proxies from the health store")
+        self.sessions = SessionFactory(self.config['validator_concurrency'])
+        self.ip_echo = IPEchoEndpoints(self.config['ip_check_urls'])
+        self.exit_ips = ExitIPCache(self.check_exit_ip, self.config['exit_ip_ttl'])
+        self.selector = ProxySelector(
+            breaker=ProxyBreaker(base=self.config['breaker_base'], cap=self.config['breaker_cap'])
+        )
+        self.load_ranked_proxies()
+        self.refresher = None
+        if self.config['auto_refresh']:
+            self.start_auto_refresh()
+        self.scheduler = Scheduler(log=self.log)
         signal.signal(signal.SIGINT, self.signal_handler)
         
     def signal_handler(self, signum, frame):
         """Handle Ctrl+C interruption"""
         print("\n🛑 Interrupt received! Shutting down...")
         self.stop_rotation()
+        self.scheduler.stop()
+        self.stop_auto_refresh()
+        if self.control_server:
+            self.control_server.stop()
         if self.local_proxy_active:
             self.stop_local_proxy()
         self.disable_kill_switch()  # Ensure kill switch is disabled
+        self.sessions.close_all()
+        self.health_store.close()
+        self.state.flush()
+        self.logger.close()
         sys.exit(0)
         
     def setup_directories(self):
@@ -97,34 +2773,33 @@ class TermuxProxyMaster:
             self.save_config()
             
     def save_config(self):
-        """Save configuration to file"""
-        try:
-            with open(CONFIG_FILE, 'w') as f:
-                json.dump(self.config, f, indent=4)
+        """Write the configuration now, along with any other pending state"""
+        # Only called on user actions, so don't wait for the debounce timer
+        self.state.mark('config')
+        saved = self.state.flush()
+        if saved:
             print(f"💾 Configuration saved to {CONFIG_FILE}")
-            return True
-        except Exception as e:
-            print(f"❌ Failed to save config: {str(e)}")
-            return False
+        else:
+            print(f"⚠️ Could not save configuration to {CONFIG_FILE}; see the log")
+        return saved
             
     def load_favorites(self):
         """Load favorites from file"""
         if os.path.exists('favorites.json'):
             try:
                 with open('favorites.json', 'r') as f:
-                    self.favorites = json.load(f)
+                    self.favorites = OrderedDict((proxy_key(fav), fav) for fav in json.load(f))
                 print(f"✅ Loaded {len(self.favorites)} favorites")
             except:
                 print("⚠️ Error loading favorites")
                 
+    def is_favorite(self, proxy):
+        return proxy_key(proxy) in self.favorites
+                
     def save_favorites(self):
-        """Save favorites to file"""
-        try:
-            with open('favorites.json', 'w') as f:
-                json.dump(self.favorites, f, indent=4)
-            return True
-        except:
-            return False
+        """Queue favorites for the next coalesced write"""
+        self.state.mark('favorites')
+        return True
             
     def load_history(self):
         """Load proxy history"""
@@ -138,75 +2813,125 @@ class TermuxProxyMaster:
             self.history = []
             
     def save_history(self):
-        """Save proxy history"""
-        try:
-            with open('history.json', 'w') as f:
-                json.dump(self.history, f, indent=4)
-            return True
-        except:
-            return False
+        """Queue proxy history for the next coalesced write"""
+        self.state.mark('history')
+        return True
             
-    def fetch_live_proxies(self):
-        """Get fresh proxies from API"""
+    def load_ranked_proxies(self, limit=500):
+        """Seed the pool from the health store so startup doesn't need a fetch"""
         try:
-            print(f"🌐 Fetching proxies from {self.config['api_url']}")
-            headers = {
-                'User-Agent': self.generate_random_user_agent(),
-                'Accept': 'application/json'
-            }
-            response = requests.get(
-                self.config['api_url'], 
-                headers=headers,
-                timeout=30
+            self.proxies = ProxyPool(
+                p for p in self.health_store.ranked(limit)
+                if p['latency'] <= self.config['max_latency']
             )
-            data = response.json()
+            for proxy in self.proxies:
+                proxy['is_favorite'] = self.is_favorite(proxy)
+            if self.proxies:
+                print(f"✅ Loaded {len(self.proxies)} ranked proxies from {HEALTH_DB}")
+        except Exception as e:
+            print(f"⚠️ Error loading proxy health store: {str(e)}")
+
+    def page_url(self, page):
+        """API URL for a given page, or None if the API isn't paginated"""
+        parsed = urlparse(self.config['api_url'])
+        params = dict(parse_qsl(parsed.query))
+        if 'page' not in params:
+            return self.config['api_url'] if page == 1 else None
+        params['page'] = str(page)
+        return parsed._replace(query=urlencode(params)).geturl()
+
+    def fetch_proxy_page(self, url):
+        """Download one API page and turn it into filtered pool entries"""
+        headers = {
+            'User-Agent': self.generate_random_user_agent(),
+            'Accept': 'application/json'
+        }
+        response = self.sessions.direct().get(url, headers=headers, timeout=30)
+        data = response.json()
+        
+        if 'data' not in data:
+            raise ValueError("API format changed! Check documentation")
             
-            if 'data' not in data:
-                print("⚠️ API format changed! Check documentation")
-                return False
+        proxies = []
+        favorite_countries = set(self.config['favorite_countries'])
+        for proxy in data['data']:
+            # Filter by latency
+            if proxy['latency'] > self.config['max_latency']:
+                continue
                 
-            self.proxies = []
-            for proxy in data['data']:
-                # Filter by latency
-                if proxy['latency'] > self.config['max_latency']:
-                    continue
-                    
-                # Filter by country preference
-                if (self.config['favorite_countries'] and 
-                    proxy['country'] not in self.config['favorite_countries']):
-                    continue
-                    
-                # Use first available protocol
-                for protocol in self.config['protocol_preference']:
-                    if protocol in proxy['protocols']:
-                        self.proxies.append({
-                            'host': proxy['ip'],
-                            'port': proxy['port'],
-                            'protocol': protocol,
-                            'country': proxy['country'],
-                            'latency': proxy['latency'],
-                            'last_checked': proxy['lastChecked'],
-                            'is_favorite': any(fav['host'] == proxy['ip'] for fav in self.favorites)
-                        })
-                        break
-                        
-            print(f"✅ Loaded {len(self.proxies)} filtered proxies")
-            self.log(f"Fetched {len(self.proxies)} proxies from API")
+            # Filter by country preference
+            if favorite_countries and proxy['country'] not in favorite_countries:
+                continue
+                
+            # Use first available protocol
+            for protocol in self.config['protocol_preference']:
+                if protocol in proxy['protocols']:
+                    entry = {
+                        'host': proxy['ip'],
+                        'port': proxy['port'],
+                        'protocol': protocol,
+                        'country': proxy['country'],
+                        'city': proxy.get('city') or '',
+                        'latency': proxy['latency'],
+                        'last_checked': proxy['lastChecked']
+                    }
+                    entry['is_favorite'] = self.is_favorite(entry)
+                    proxies.append(entry)
+                    break
+        return proxies, data
+
+    def ingest_page(self, proxies):
+        """Merge one page into the pool and the health store"""
+        added, updated = self.proxies.merge(proxies)
+        self.cache_proxies(proxies)
+        return added, updated
+
+    def fetch_live_proxies(self, pages=None, verbose=True):
+        """Get fresh proxies from API, merging every page into the existing pool"""
+        pages = pages or self.config['api_pages']
+        try:
+            if verbose:
+                print(f"🌐 Fetching proxies from {self.config['api_url']}")
+            first, data = self.fetch_proxy_page(self.page_url(1))
+            added, updated = self.ingest_page(first)
+            
+            # The first page tells us how many pages actually exist
+            limit = int(data.get('limit') or len(data['data']) or 1)
+            available = -(-int(data.get('total') or 0) // limit)
+            urls = [url for url in (self.page_url(n) for n in range(2, min(pages, available) + 1)) if url]
             
-            # Cache proxies
-            self.cache_proxies()
+            if urls:
+                if verbose:
+                    print(f"📄 Fetching {len(urls)} more pages in parallel...")
+                with ThreadPoolExecutor(max_workers=self.config['api_page_workers']) as executor:
+                    futures = [executor.submit(self.fetch_proxy_page, url) for url in urls]
+                    for future in as_completed(futures):
+                        try:
+                            page, _ = future.result()
+                        except Exception as e:
+                            self.log(f"Proxy page fetch failed: {str(e)}", level='error')
+                            continue
+                        page_added, page_updated = self.ingest_page(page)
+                        added += page_added
+                        updated += page_updated
+                        
+            evicted = self.proxies.trim(self.config['max_pool_size'])
+            if verbose:
+                print(f"✅ Pool: {len(self.proxies)} proxies ({added} new, {updated} refreshed, {evicted} evicted)")
+            self.log(f"Fetched proxies from API: {added} new, {updated} refreshed, pool {len(self.proxies)}")
             return True
             
         except Exception as e:
-            self.log(f"Proxy fetch failed: {str(e)}")
-            print(f"❌ Proxy fetch error: {str(e)}")
+            self.log(f"Proxy fetch failed: {str(e)}", level='error')
+            if verbose:
+                print(f"❌ Proxy fetch error: {str(e)}")
             return False
 
     def fetch_tor_bridges(self):
         """Fetch Tor bridges for enhanced anonymity"""
         try:
             print("🌐 Fetching Tor bridges...")
-            response = requests.get(TOR_BRIDGES_URL, timeout=15)
+            response = self.sessions.direct().get(TOR_BRIDGES_URL, timeout=15)
             if response.status_code == 200:
                 self.tor_bridges = response.text.strip().split('\n')
                 print(f"✅ Loaded {len(self.tor_bridges)} Tor bridges")
@@ -215,72 +2940,134 @@ class TermuxProxyMaster:
             print(f"❌ Tor bridge fetch failed: {str(e)}")
         return False
 
-    def cache_proxies(self):
-        """Cache proxies to file"""
-        cache_file = f"proxy_cache/proxies_{datetime.now().strftime('%Y%m%d_%H%M')}.json"
+    def cache_proxies(self, proxies=None):
+        """Record fetched proxies in the health store"""
         try:
-            with open(cache_file, 'w') as f:
-                json.dump(self.proxies, f, indent=4)
-            print(f"💾 Proxies cached to {cache_file}")
-        except:
-            print("⚠️ Failed to cache proxies")
-
-    def test_proxy(self, proxy, timeout=3):
-        """Test proxy connection with timeout"""
-        test_url = f"{proxy['protocol']}://{proxy['host']}:{proxy['port']}"
-        proxies = {
-            'http': test_url,
-            'https': test_url
-        }
-        
+            self.health_store.upsert_seen(self.proxies if proxies is None else proxies)
+        except Exception as e:
+            print(f"⚠️ Failed to cache proxies: {str(e)}")
+
+    def check_exit_ip(self, proxy, timeout=3):
+        """Ask the IP echo services which address we appear from, via proxy or directly"""
+        session = self.sessions.direct() if proxy is None else self.sessions.for_proxy(proxy)
+        headers = {'User-Agent': self.generate_random_user_agent()}
+
+        def ask(url):
+            response = session.get(url, timeout=timeout, headers=headers)
+            # Track traffic
+            self.traffic_stats['received'] += len(response.content)
+            return parse_echo_ip(response.status_code, response.text)
+
+        start = time.time()
+        ip = self.ip_echo.first(ask)
+        return {'ip': ip, 'latency': int((time.time() - start) * 1000)}
+
+    def test_proxy(self, proxy, timeout=3, max_age=0):
+        """Test proxy connection with timeout; always live unless max_age allows a cached check"""
         try:
-            start = time.time()
-            response = requests.get(
-                IP_CHECK_URL,
-                proxies=proxies,
-                timeout=timeout,
-                headers={'User-Agent': self.generate_random_user_agent()}
-            )
-            latency = int((time.time() - start) * 1000)
-            
-            if response.status_code == 200:
-                # Track traffic
-                self.traffic_stats['received'] += len(response.content)
-                return {
-                    'working': True,
-                    'ip': response.text.strip(),
-                    'latency': latency
-                }
-        except:
+            result = self.exit_ips.get(proxy, max_age, timeout=timeout)
+            self.selector.breaker.record(self.proxies.get(proxy_key(proxy)) or proxy, True)
+            return {'working': True, 'ip': result['ip'], 'latency': result['latency']}
+        except Exception:
             pass
+        self.exit_ips.invalidate(proxy)
+        self.selector.breaker.record(self.proxies.get(proxy_key(proxy)) or proxy, False)
+        self.sessions.discard(proxy)
+        if self.local_proxy:
+            self.local_proxy.mark_dead(proxy)
+        if self.refresher:
+            self.refresher.discard(proxy)
         return {'working': False}
 
-    def find_working_proxy(self, max_attempts=15):
+    def find_working_proxy(self, max_attempts=None):
         """Find a working proxy with intelligent selection"""
-        if not self.proxies:
-            print("⚠️ No proxies available! Fetching new proxies...")
-            if not self.fetch_live_proxies():
-                return None
+        working = self.find_working_proxies(1, max_attempts)
+        return working[0] if working else None
+
+    def find_working_proxies(self, count=1, max_attempts=None, verbose=True, exclude=(), candidates=None):
+        """Validate the pool (or just `candidates`) concurrently and return the first `count` that answer"""
+        if candidates is None and not self.proxies:
+            if verbose:
+                print("⚠️ No proxies available! Fetching new proxies...")
+            if not self.fetch_live_proxies(verbose=verbose):
+                return []
                 
-        # Create a prioritized list (favorites first, then by latency)
-        candidates = [p for p in self.proxies if p.get('is_favorite', False)]
-        if not candidates:
-            candidates = sorted(self.proxies, key=lambda x: x['latency'])
-        
-        # Ensure we don't exceed max attempts
-        candidates = candidates[:max_attempts]
-        random.shuffle(candidates)  # Add randomness for load distribution
+        if candidates is None:
+            # Favorites first, then the pool sampled by measured cost per success
+            favorites = []
+            others = []
+            for proxy in self.proxies:
+                if exclude and proxy_key(proxy) in exclude:
+                    continue
+                (favorites if proxy.get('is_favorite', False) else others).append(proxy)
+            if max_attempts:
+                favorites = favorites[:max_attempts]
+            limit = max_attempts - len(favorites) if max_attempts else None
+            candidates = favorites + self.selector.order(others, limit)
+        else:
+            # Standby entries are validator copies; record outcomes on the pool's own records
+            candidates = [self.proxies.get(proxy_key(p)) or p for p in candidates]
         
-        for i, proxy in enumerate(candidates):
-            print(f"🔎 Testing {proxy['host']}:{proxy['port']} ({proxy['protocol'].upper()})")
-            result = self.test_proxy(proxy, timeout=5)
-            
+        validator = AsyncProxyValidator(
+            endpoints=self.ip_echo,
+            max_in_flight=self.config['validator_concurrency'],
+            timeout=self.config['validator_timeout'],
+            user_agent=self.generate_random_user_agent(),
+            breaker=self.selector.breaker
+        )
+        if verbose:
+            print(f"🔎 Testing {len(candidates)} proxies ({validator.max_in_flight} in flight)")
+        outcomes = []
+
+        def record(proxy, result):
+            outcomes.append((proxy, result))
+            self.selector.record(proxy, result)
             if result['working']:
-                print(f"✅ Found working proxy: {result['ip']} | Latency: {result['latency']}ms")
-                return {**proxy, **result}
+                self.proxies.reindex(proxy)
+                self.exit_ips.put(proxy, result['ip'], latency=result['latency'])
+
+        working = validator.validate_sync(candidates, want=count, on_result=record)
+        try:
+            self.health_store.record_results(outcomes)
+        except Exception as e:
+            self.log(f"Health store update failed: {str(e)}", level='error')
+        if self.local_proxy:
+            for proxy, result in outcomes:
+                if not result['working']:
+                    self.local_proxy.mark_dead(proxy)
         
-        print("❌ No working proxies found in batch")
-        return None
+        for proxy in working:
+            self.traffic_stats['received'] += proxy.pop('bytes', 0)
+            if verbose:
+                print(f"✅ Found working proxy: {proxy['ip']} | Latency: {proxy['latency']}ms")
+        if not working and verbose:
+            print("❌ No working proxies found in batch")
+        return working
+
+    def start_auto_refresh(self):
+        """Refetch and revalidate in the background every refresh_interval minutes"""
+        if self.refresher:
+            return False
+        self.refresher = PoolRefresher(
+            fetch=lambda: self.fetch_live_proxies(verbose=False),
+            validate=lambda count, exclude, candidates=None: self.find_working_proxies(
+                count, verbose=False, exclude=exclude, candidates=candidates),
+            interval_min=self.config['refresh_interval'],
+            standby_size=self.config['warm_pool_size'],
+            standby_ttl=self.config['standby_ttl'],
+            log=self.log
+        )
+        self.refresher.start()
+        print(f"♻️ Auto-refresh every {self.config['refresh_interval']} min "
+              f"(keeping {self.config['warm_pool_size']} verified proxies on standby)")
+        return True
+
+    def stop_auto_refresh(self):
+        if not self.refresher:
+            return False
+        self.refresher.stop()
+        self.refresher = None
+        return True
 
     def set_termux_proxy(self, proxy):
         """Set proxy for Termux environment"""
@@ -292,23 +3079,32 @@ class TermuxProxyMaster:
             if self.config['single_host_mode']:
                 proxy_host = LOCAL_PROXY_HOST
                 proxy_port = LOCAL_PROXY_PORT
+                proxy_url = f"http://{proxy_host}:{proxy_port}"
                 print(f"🔒 Using fixed proxy: {proxy_host}:{proxy_port}")
+                if not self.local_proxy_active and not self.start_local_proxy():
+                    return False
+                # New connections pick up the new upstream; open tunnels finish on the old one
+                self.local_proxy.set_upstream(proxy)
             else:
                 proxy_host = proxy['host']
                 proxy_port = proxy['port']
+                proxy_url = f"{proxy['protocol']}://{proxy_host}:{proxy_port}"
             
-            # Set environment variables
-            proxy_url = f"{proxy['protocol']}://{proxy_host}:{proxy_port}"
-            os.environ['HTTP_PROXY'] = proxy_url
-            os.environ['HTTPS_PROXY'] = proxy_url
-            
-            # For curl/wget support
-            with open(os.path.expanduser('~/.curlrc'), 'w') as f:
-                f.write(f"proxy = {proxy_url}\n")
+            # The fixed endpoint never changes, so only rewrite settings when they differ
+            if os.environ.get('HTTP_PROXY') != proxy_url:
+                # Set environment variables
+                os.environ['HTTP_PROXY'] = proxy_url
+                os.environ['HTTPS_PROXY'] = proxy_url
+                
+                # For curl/wget support
+                with open(os.path.expanduser('~/.curlrc'), 'w') as f:
+                    f.write(f"proxy = {proxy_url}\n")
                 
             # Save current proxy
             self.current_proxy = proxy
-            self.log(f"Proxy set: {proxy_host}:{proxy_port} | IP: {proxy['ip']}")
+            self.selector.mark_used(self.proxies.get(proxy_key(proxy)) or proxy)
+            self.log(f"Proxy set: {proxy_host}:{proxy_port} | IP: {proxy['ip']}",
+                     host=proxy_host, port=proxy_port, protocol=proxy['protocol'], ip=proxy['ip'])
             
             # Add to history
             self.add_to_history(proxy)
@@ -335,7 +3131,7 @@ class TermuxProxyMaster:
                 
             return True
         except Exception as e:
-            self.log(f"Proxy set failed: {str(e)}")
+            self.log(f"Proxy set failed: {str(e)}", level='error')
             return False
 
     def add_to_history(self, proxy):
@@ -359,73 +3155,206 @@ class TermuxProxyMaster:
 
     def add_favorite(self, proxy):
         """Add proxy to favorites"""
-        if not any(fav['host'] == proxy['host'] for fav in self.favorites):
-            self.favorites.append({
+        key = proxy_key(proxy)
+        if key not in self.favorites:
+            self.favorites[key] = {
                 'host': proxy['host'],
                 'port': proxy['port'],
                 'protocol': proxy['protocol'],
                 'country': proxy.get('country', ''),
                 'added': datetime.now().isoformat()
-            })
-            print(f"🌟 Added {proxy['host']} to favorites")
+            }
+            self.tag_favorite(key, True)
+            print(f"🌟 Added {proxy['host']}:{proxy['port']} to favorites")
             self.save_favorites()
             return True
         return False
 
-    def remove_favorite(self, host):
+    def remove_favorite(self, proxy):
         """Remove proxy from favorites"""
-        self.favorites = [fav for fav in self.favorites if fav['host'] != host]
-        print(f"🗑️ Removed {host} from favorites")
+        key = proxy_key(proxy)
+        if self.favorites.pop(key, None) is None:
+            return False
+        self.tag_favorite(key, False)
+        print(f"🗑️ Removed {proxy['host']}:{proxy['port']} from favorites")
         self.save_favorites()
         return True
 
+    def tag_favorite(self, key, flag):
+        """Keep the pool entry's is_favorite in step with the favorites index"""
+        record = self.proxies.get(key)
+        if record is not None:
+            record['is_favorite'] = flag
+
     def rotate_proxy(self):
         """Rotate to a new working proxy"""
-        print("\n🔄 Rotating IP address...")
-        new_proxy = self.find_working_proxy()
-        if new_proxy and self.set_termux_proxy(new_proxy):
-            if self.config['notifications']:
-                self.show_notification("Proxy Rotated", f"New IP: {new_proxy['ip']}")
-            return new_proxy
-        return None
+        # The rotation thread and control clients may both ask for a rotation
+        with self.rotate_lock:
+            if self.pinned_proxy:
+                print(f"📌 Proxy pinned to {self.pinned_proxy['host']}:{self.pinned_proxy['port']}, not rotating")
+                return self.pinned_proxy
+            print("\n🔄 Rotating IP address...")
+            # Prefer a proxy from the standby queue, verified within standby_ttl
+            new_proxy = self.refresher.pop() if self.refresher else None
+            if new_proxy:
+                print(f"⚡ Using standby proxy: {new_proxy['ip']} | Latency: {new_proxy['latency']}ms")
+            else:
+                new_proxy = self.find_working_proxy()
+            if new_proxy and self.set_termux_proxy(new_proxy):
+                if self.config['notifications']:
+                    self.show_notification("Proxy Rotated", f"New IP: {new_proxy['ip']}")
+                return new_proxy
+            return None
+
+    def pin_proxy(self, host, port, protocol='http'):
+        """Switch to a specific proxy and hold it until unpinned"""
+        key = (host, int(port), protocol)
+        proxy = self.proxies.get(key) or {'host': host, 'port': int(port), 'protocol': protocol}
+        result = self.test_proxy(proxy)
+        if not result['working']:
+            raise ValueError(f"{host}:{port} is not responding")
+        proxy.update(ip=result['ip'], latency=result['latency'])
+        with self.rotate_lock:
+            if not self.set_termux_proxy(proxy):
+                raise RuntimeError(f"could not switch to {host}:{port}")
+            self.pinned_proxy = proxy
+        self.log(f"Proxy pinned: {host}:{port}")
+        return self.describe_proxy(proxy)
+
+    def unpin_proxy(self):
+        """Let rotation resume choosing proxies"""
+        proxy, self.pinned_proxy = self.pinned_proxy, None
+        if proxy:
+            self.log(f"Proxy unpinned: {proxy['host']}:{proxy['port']}")
+        return self.describe_proxy(proxy)
+
+    @staticmethod
+    def describe_proxy(proxy):
+        if not proxy:
+            return None
+        return {field: proxy.get(field) for field in
+                ('host', 'port', 'protocol', 'ip', 'latency', 'country', 'city')}
+
+    def status(self):
+        """Snapshot of the running state for the control API"""
+        return {
+            'current': self.describe_proxy(self.current_proxy),
+            'pinned': bool(self.pinned_proxy),
+            'rotation_active': self.rotation_active,
+            'jobs': self.scheduler.describe(),
+            'auto_refresh': bool(self.refresher),
+            'local_proxy': f"{LOCAL_PROXY_HOST}:{LOCAL_PROXY_PORT}" if self.local_proxy_active else None,
+            'traffic': dict(self.traffic_stats)
+        }
+
+    def pool_stats(self):
+        """Pool, standby queue, health store and forwarder counters"""
+        stats = {
+            'pool_size': len(self.proxies),
+            'by_protocol': self.proxies.values('protocol'),
+            'standby': len(self.refresher.standby) if self.refresher else 0,
+            'last_refresh': self.refresher.last_refresh if self.refresher else None,
+            'health_store': self.health_store.stats()
+        }
+        if self.local_proxy:
+            stats['forwarder'] = dict(self.local_proxy.stats)
+            stats['upstream_pool'] = dict(self.local_proxy.pool.stats)
+            stats['upstreams'] = self.local_proxy.balancer.snapshot()
+        return stats
+
+    def control_handlers(self):
+        return {
+            'ping': lambda: 'pong',
+            'status': self.status,
+            'stats': self.pool_stats,
+            'rotate': lambda: self.describe_proxy(self.rotate_proxy()),
+            'pin': self.pin_proxy,
+            'unpin': self.unpin_proxy,
+            'refresh': lambda: self.fetch_live_proxies(verbose=False) and len(self.proxies),
+            'shutdown': lambda: self.daemon_stopped.set() or 'stopping'
+        }
+
+    def run_daemon(self, interval_min=None, socket_path=CONTROL_SOCKET):
+        """Headless mode: keep the pool, standby queue and forwarder running behind a control socket"""
+        signal.signal(signal.SIGTERM, self.signal_handler)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        self.config['notifications'] = False
+        self.control_server = ControlServer(self.control_handlers(), socket_path, log=self.log)
+        self.control_server.start()
+        self.log(f"Daemon started, control socket {socket_path}")
+        print(f"🛰️ Daemon listening on {socket_path}")
+        self.detach_output()
+
+        if not self.proxies:
+            self.fetch_live_proxies(verbose=False)
+        self.start_auto_refresh()
+        if self.config['single_host_mode'] and not self.local_proxy_active:
+            self.start_local_proxy()
+        if interval_min:
+            self.start_rotation(interval_min, 0)
+        else:
+            self.rotate_proxy()
+
+        self.daemon_stopped.wait()
+        self.signal_handler(signal.SIGTERM, None)
+
+    def detach_output(self):
+        """Point stdout/stderr at /dev/null so prints can't fail once the launching terminal is gone"""
+        # The daemon reports through the JSON log; a closed tty would turn every print into EIO
+        sys.stdout.flush()
+        sys.stderr.flush()
+        devnull = open(os.devnull, 'w')
+        os.dup2(devnull.fileno(), sys.__stdout__.fileno())
+        os.dup2(devnull.fileno(), sys.__stderr__.fileno())
+        sys.stdout = sys.stderr = devnull
 
     def start_rotation(self, interval_min, duration_hr):
         """Start automatic proxy rotation with infinite option"""
+        if interval_min <= 0:
+            print("⚠️ Rotation interval must be at least one minute")
+            return False
         self.rotation_active = True
+        # Keep the standby queue full so each rotation is a pop, not a fetch + test
+        self.start_auto_refresh()
         
         # Handle infinite rotation
         if duration_hr <= 0:
-            end_time = None
+            until = None
             print("♾️ Rotation started: Runs indefinitely until manually stopped")
         else:
-            end_time = datetime.now() + timedelta(hours=duration_hr)
+            until = time.time() + duration_hr * 3600
             print(f"⏱ Rotation started: {interval_min} min intervals for {duration_hr} hours")
         
-        def rotation_loop():
-            while self.rotation_active and (end_time is None or datetime.now() < end_time):
-                proxy_info = self.rotate_proxy()
-                if proxy_info:
-                    print(f"⏱ Next rotation in {interval_min} minutes")
-                    self.show_wifi_instructions(proxy_info)
-                else:
-                    print("⚠️ Rotation failed, retrying in 30 seconds")
-                    time.sleep(30)
-                    continue
-                    
-                time.sleep(interval_min * 60)
+        failures = [0]
+        
+        def rotate():
+            proxy_info = self.rotate_proxy()
+            if proxy_info:
+                failures[0] = 0
+                print(f"⏱ Next rotation in {interval_min} minutes")
+                self.show_wifi_instructions(proxy_info)
+                return None
+            # Back off so an exhausted pool isn't rescanned every few seconds
+            delay = backoff_delay(failures[0], 30, max(60, interval_min * 60))
+            failures[0] += 1
+            print(f"⚠️ Rotation failed, retrying in {delay:.0f} seconds")
+            return delay
+            
+        def finished():
             self.rotation_active = False
             print("\n⏹ Rotation schedule completed")
             
-        self.rotation_thread = threading.Thread(target=rotation_loop)
-        self.rotation_thread.daemon = True
-        self.rotation_thread.start()
+        self.scheduler.every(interval_min * 60, rotate, name='rotation', first_run=0,
+                             until=until, on_finish=finished)
+        return True
 
     def stop_rotation(self):
         """Stop automatic rotation"""
         if self.rotation_active:
             self.rotation_active = False
-            if self.rotation_thread and self.rotation_thread.is_alive():
-                self.rotation_thread.join(timeout=2)
+            self.scheduler.cancel('rotation')
+            if not self.config['auto_refresh']:
+                self.stop_auto_refresh()
             print("\n⏹ Proxy rotation stopped")
             return True
         return False
@@ -516,6 +3445,9 @@ class TermuxProxyMaster:
         print("    (IP changes automatically behind this address)")
         self.save_config()
         
+        if not self.config['single_host_mode'] and self.local_proxy_active:
+            self.stop_local_proxy()
+        
         # Update environment if proxy is active
         if self.current_proxy:
             self.set_termux_proxy(self.current_proxy)
@@ -529,12 +3461,28 @@ class TermuxProxyMaster:
             
         try:
             print("🚀 Starting local proxy server...")
-            # This would be a separate implementation
-            # For now, we'll simulate it
+            self.local_proxy = LocalForwarder(
+                LOCAL_PROXY_HOST, LOCAL_PROXY_PORT,
+                zero_copy=self.config['relay_zero_copy'],
+                buffer_size=self.config['relay_buffer_kb'] * 1024,
+                max_buffers=self.config['relay_max_buffers'],
+                idle_timeout=self.config['upstream_idle_timeout'],
+                max_per_host=self.config['upstream_max_per_host'],
+                prewarm=self.config['upstream_prewarm'],
+                balance=self.config['balance_strategy'],
+                sticky=self.config['balance_sticky'],
+                max_failures=self.config['balance_max_failures'],
+                quarantine=self.config['balance_quarantine']
+            )
+            self.local_proxy.set_upstream(self.current_proxy)
+            self.local_proxy.start()
+            self.local_proxy_thread = self.local_proxy.thread
             self.local_proxy_active = True
-            print("✅ Local proxy running at 127.0.0.1:8080")
+            print(f"✅ Local proxy running at {LOCAL_PROXY_HOST}:{LOCAL_PROXY_PORT} (HTTP CONNECT + SOCKS5)")
+            self.log(f"Local proxy started on {LOCAL_PROXY_HOST}:{LOCAL_PROXY_PORT}")
             return True
         except Exception as e:
+            self.local_proxy = None
             print(f"❌ Failed to start local proxy: {str(e)}")
             return False
 
@@ -546,6 +3494,9 @@ class TermuxProxyMaster:
             
         try:
             print("🛑 Stopping local proxy server...")
+            self.local_proxy.stop()
+            self.local_proxy = None
+            self.local_proxy_thread = None
             self.local_proxy_active = False
             print("✅ Local proxy stopped")
             return True
@@ -601,13 +3552,9 @@ class TermuxProxyMaster:
         print(f"⏱ Testing speed for {target['host']}:{target['port']}...")
         
         try:
-            test_url = f"{target['protocol']}://{target['host']}:{target['port']}"
-            proxies = {'http': test_url, 'https': test_url}
-            
             start = time.time()
-            response = requests.get(
+            response = self.sessions.for_proxy(target).get(
                 test_url,
-                proxies=proxies,
                 timeout=timeout,
                 stream=True
             )
@@ -625,19 +3572,9 @@ class TermuxProxyMaster:
             print(f"❌ Speed test failed: {str(e)}")
             return None
 
-    def log(self, message):
-        """Log to file with timestamp"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_entry = f"[{timestamp}] {message}"
-        
-        # Write to main log
-        with open(LOG_FILE, 'a') as f:
-            f.write(log_entry + "\n")
-            
-        # Write to daily log
-        daily_log = f"logs/proxy_{datetime.now().strftime('%Y%m%d')}.log"
-        with open(daily_log, 'a') as f:
-            f.write(log_entry + "\n")
+    def log(self, message, level='info', **fields):
+        """Queue a structured log record; the writer thread does the disk I/O"""
+        self.logger.log(message, level, **fields)
 
     # ===== NEW FEATURES =====
     def setup_proxy_chain(self):
@@ -901,10 +3838,13 @@ def main():
                 continue
                 
             interval = input("⏱ Rotation interval (minutes) [5]: ").strip()
-            interval = int(interval) if interval else 5
-            
             duration = input("⏳ Duration (hours, 0=infinite) [1]: ").strip()
-            duration = float(duration) if duration else 1.0
+            try:
+                interval = int(interval) if interval else 5
+                duration = float(duration) if duration else 1.0
+            except ValueError:
+                print("⚠️ Interval and duration must be numbers")
+                continue
             
             proxy_master.start_rotation(interval, duration)
         
@@ -948,8 +3888,10 @@ def main():
             print(f"9. DNS Protection: {'✅ Enabled' if proxy_master.config['dns_protection'] else '❌ Disabled'}")
             print(f"10. MAC Randomization: {'✅ Enabled' if proxy_master.config['mac_randomization'] else '❌ Disabled'}")
             print(f"11. Browser Spoofing: {'✅ Enabled' if proxy_master.config['browser_spoofing'] else '❌ Disabled'}")
+            print(f"12. Auto Refresh: {'✅ Enabled' if proxy_master.config['auto_refresh'] else '❌ Disabled'}")
+            print(f"13. Refresh Interval: {proxy_master.config['refresh_interval']} min")
             
-            sub_choice = input("\nSelect setting to change (1-11) or [Enter] to return: ")
+            sub_choice = input("\nSelect setting to change (1-13) or [Enter] to return: ")
             if sub_choice == '1':
                 new_url = input("Enter new API URL: ").strip()
                 if new_url:
@@ -995,6 +3937,20 @@ def main():
             elif sub_choice == '11':
                 proxy_master.config['browser_spoofing'] = not proxy_master.config['browser_spoofing']
                 print(f"Browser Spoofing {'✅ enabled' if proxy_master.config['browser_spoofing'] else '❌ disabled'}")
+            elif sub_choice == '12':
+                proxy_master.config['auto_refresh'] = not proxy_master.config['auto_refresh']
+                print(f"Auto Refresh {'✅ enabled' if proxy_master.config['auto_refresh'] else '❌ disabled'}")
+                if proxy_master.config['auto_refresh']:
+                    proxy_master.start_auto_refresh()
+                else:
+                    proxy_master.stop_auto_refresh()
+            elif sub_choice == '13':
+                try:
+                    proxy_master.config['refresh_interval'] = int(input("Enter refresh interval (minutes): "))
+                    if proxy_master.stop_auto_refresh():
+                        proxy_master.start_auto_refresh()
+                except:
+                    print("Invalid input")
             
             proxy_master.save_config()
         
@@ -1005,7 +3961,7 @@ def main():
             if not proxy_master.favorites:
                 print("No favorites yet")
             else:
-                for i, fav in enumerate(proxy_master.favorites, 1):
+                for i, fav in enumerate(proxy_master.favorites.values(), 1):
                     print(f"{i}. {fav['host']}:{fav['port']} ({fav['protocol'].upper()}) - {fav['country']}")
             
             print("\na. ➕ Add current proxy")
@@ -1019,13 +3975,15 @@ def main():
                 try:
                     index = int(input("Enter favorite number to remove: ")) - 1
                     if 0 <= index < len(proxy_master.favorites):
-                        proxy_master.remove_favorite(proxy_master.favorites[index]['host'])
+                        proxy_master.remove_favorite(list(proxy_master.favorites.values())[index])
                 except:
                     print("Invalid selection")
             elif fav_choice == 'c' and proxy_master.favorites:
                 confirm = input("⚠️ Clear ALL favorites? (y/n): ").lower()
                 if confirm == 'y':
-                    proxy_master.favorites = []
+                    for key in list(proxy_master.favorites):
+                        proxy_master.tag_favorite(key, False)
+                    proxy_master.favorites.clear()
                     proxy_master.save_favorites()
                     print("🧹 All favorites cleared")
         
@@ -1075,12 +4033,57 @@ def main():
         
         elif choice == '17':
             proxy_master.stop_rotation()
+            proxy_master.stop_auto_refresh()
+            if proxy_master.local_proxy_active:
+                proxy_master.stop_local_proxy()
             print("\n🔌 Exiting Termux Proxy Master")
             break
         
         else:
             print("⚠️ Invalid selection")
+            
+    # Write pending state and let the log writer drain before the process exits
+    proxy_master.state.flush()
+    proxy_master.logger.close()
 
 # ===== RUN APPLICATION =====
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description=f"Termux Proxy Master v{VERSION}")
+    parser.add_argument('--daemon', action='store_true',
+                        help="run headless, controlled through the control socket")
+    parser.add_argument('--interval', type=float, metavar='MIN',
+                        help="with --daemon, rotate every MIN minutes")
+    parser.add_argument('--socket', default=CONTROL_SOCKET, metavar='PATH',
+                        help=f"control socket path (default {CONTROL_SOCKET})")
+    parser.add_argument('--ctl', nargs='+', metavar='ARG',
+                        help="send a command to a running daemon, e.g. --ctl pin host=1.2.3.4 port=8080")
+    parser.add_argument('--bench-relay', nargs='?', const=256, type=int, metavar='MB',
+                        help="benchmark the forwarder relay with MB of data")
+    parser.add_argument('--echo-server', nargs='?', const=8099, type=int, metavar='PORT',
+                        help="serve a local IP echo endpoint for offline validator checks")
+    args = parser.parse_args()
+
+    if args.echo_server:
+        echo = IPEchoServer(port=args.echo_server)
+        print(f"🔁 IP echo server on {echo.url} (Ctrl+C to stop)")
+        try:
+            echo.server.serve_forever()
+        except KeyboardInterrupt:
+            echo.stop()
+    elif args.bench_relay:
+        benchmark_relay(args.bench_relay, zero_copy=True)
+        benchmark_relay(args.bench_relay, zero_copy=False)
+    elif args.ctl:
+        command, *params = args.ctl
+        try:
+            reply = control_request(command, path=args.socket,
+                                    **dict(param.split('=', 1) for param in params))
+        except (OSError, ValueError) as e:
+            print(f"❌ Daemon not reachable at {args.socket}: {str(e)}")
+            sys.exit(1)
+        print(json.dumps(reply, indent=2))
+        sys.exit(0 if reply.get('ok') else 1)
+    elif args.daemon:
+        TermuxProxyMaster().run_daemon(args.interval, args.socket)
+    else:
+        main()
\ No newline at end of file
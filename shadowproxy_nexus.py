@@ -1,13 +1,12 @@
 #!/usr/bin/env python3
+import time
+STARTUP_BEGIN = time.perf_counter()
 import os
 import re
 import sys
-import time
 import json
 import random
 import signal
-import requests
-import threading
 import subprocess
 import platform
 import socket
@@ -16,28 +15,25 @@ import uuid
 import sqlite3
 import shutil
 import base64
-import geoip2.database
-import qrcode
+import importlib
+import importlib.util
 import fcntl
 import readline
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from urllib.parse import urlparse
-from Crypto.Cipher import AES
-from Crypto.Util.Padding import pad, unpad
-from PIL import Image
-import stem.process
-from stem.control import Controller
-import nmap
-from scapy.all import *
-import OpenSSL
-import faker
+from proxymasterv5 import (
+    AsyncProxyValidator, ExitIPCache, IPEchoEndpoints, LocalForwarder, PoolRefresher,
+    ProxyBreaker, ProxyHealthStore, ProxyPool, ProxySelector, Scheduler, SessionFactory,
+    StateStore, HEALTH_DB, IP_CHECK_URLS, backoff_delay, parse_echo_ip, proxy_key
+)
 
 # ===== CONFIGURATION =====
 PROXY_API_URL = "https://proxylist.geonode.com/api/proxy-list?limit=500&page=1&sort_by=lastChecked&sort_type=desc"
 TOR_BRIDGES_URL = "https://bridges.torproject.org/bridges?transport=obfs4"
 LOG_FILE = "shadowproxy.log"
 ROTATION_INTERVAL = 300  # 5 minutes default
-IP_CHECK_URL = "http://icanhazip.com"
 CONFIG_FILE = "proxy_config.json"
 LOCAL_PROXY_HOST = "127.0.0.1"
 LOCAL_PROXY_PORT = 8080
@@ -47,6 +43,35 @@ MAC_PREFIXES = ["00:16:3e", "00:0c:29", "00:50:56", "00:1c:42", "00:1d:0f"]
 GEOIP_DB_PATH = "GeoLite2-City.mmdb"
 PLUGINS_DIR = "plugins"
 
+# Heavy optional dependencies are imported by the feature that needs them,
+# so proxy rotation starts fast and works without them installed
+OPTIONAL_PACKAGES = {
+    'geoip2.database': 'geoip2',
+    'stem.process': 'stem',
+    'stem.control': 'stem',
+    'nmap': 'python-nmap',
+    'scapy.all': 'scapy',
+    'OpenSSL': 'pyOpenSSL',
+    'faker': 'faker',
+}
+
+def require(module):
+    """Import an optional dependency on first use, with an install hint if missing"""
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        package = OPTIONAL_PACKAGES.get(module, module.split('.')[0])
+        raise ImportError(f"{module} is not installed (pip install {package})") from None
+
+def startup_report(imports_done, ready):
+    """Print where startup time went and confirm no optional dependency was loaded eagerly"""
+    print(f"⏱ Startup: imports {(imports_done - STARTUP_BEGIN) * 1000:.0f}ms | "
+          f"init {(ready - imports_done) * 1000:.0f}ms | "
+          f"total {(ready - STARTUP_BEGIN) * 1000:.0f}ms | {len(sys.modules)} modules")
+    eager = sorted({OPTIONAL_PACKAGES[m] for m in OPTIONAL_PACKAGES if m in sys.modules})
+    if eager:
+        print(f"⚠️ Loaded at startup: {', '.join(eager)}")
+
 # ===== SHADOWPROXY NEXUS BANNER =====
 def display_banner():
     print("\033[1;35m")
@@ -74,14 +99,14 @@ def display_banner():
 # ===== SHADOWPROXY NEXUS CORE =====
 class ShadowProxyNexus:
     def __init__(self):
-        self.proxies = []
+        self.proxies = ProxyPool()
         self.tor_bridges = []
         self.current_proxy = None
-        self.favorites = []
+        self.favorites = OrderedDict()  # proxy_key -> favorite entry, in the order added
         self.rotation_active = False
-        self.rotation_thread = None
         self.local_proxy_active = False
         self.local_proxy_thread = None
+        self.local_proxy = None
         self.config = {
             # Existing configuration
             "api_url": PROXY_API_URL,
@@ -107,6 +132,10 @@ class ShadowProxyNexus:
             "ai_anomaly_detection": False,
             "auto_rotate_fail": True,
             "proxy_load_balancing": False,
+            "balance_strategy": "least_conn",
+            "balance_sticky": False,
+            "balance_max_failures": 3,
+            "balance_quarantine": 60,
             "bandwidth_throttle": 0,
             "proxy_health_alerts": True,
             "proxy_uptime_monitor": False,
@@ -132,41 +161,86 @@ class ShadowProxyNexus:
             "metasploit_integration": False,
             "nmap_integration": False,
             "android_vpn": False,
-            "custom_proxy_sources": []
+            "custom_proxy_sources": [],
+            "validator_concurrency": 100,
+            "validator_timeout": 5,
+            "warm_pool_size": 5,
+            "standby_ttl": 120,
+            "breaker_base": 30,
+            "breaker_cap": 3600,
+            "blacklist_after": 8,
+            "tor_pool_size": 4,
+            "tor_pool_base_port": 9060,
+            "exit_ip_ttl": 60,
+            "ip_check_urls": list(IP_CHECK_URLS)
         }
+        self.state = StateStore()
+        self.state.register('config', CONFIG_FILE, lambda: dict(self.config), indent=4)
+        self.state.register('favorites', 'favorites.json', lambda: list(self.favorites.values()))
+        self.state.register('history', 'history.json', lambda: list(self.history))
         self.load_config()
         self.setup_directories()
         self.load_favorites()
         self.load_history()
         self.traffic_stats = {"sent": 0, "received": 0}
-        self.proxy_uptime = {}
-        self.blacklist = []
+        self.health_store = ProxyHealthStore()
+        # Every import adds rows; drop proxies gone for a week so the store stays bounded
+        self.health_store.prune()
+        self.sessions = SessionFactory(self.config['validator_concurrency'])
+        self.ip_echo = IPEchoEndpoints(self.config['ip_check_urls'])
+        self.exit_ips = ExitIPCache(self.check_exit_ip, self.config['exit_ip_ttl'])
+        self.selector = ProxySelector(
+            breaker=ProxyBreaker(base=self.config['breaker_base'], cap=self.config['breaker_cap'])
+        )
+        self.proxies = ProxyPool(self.health_store.ranked())
+        if self.proxies:
+            print(f"✅ Loaded {len(self.proxies)} ranked proxies from {HEALTH_DB}")
+        self.blacklist = set()
+        self.scheduler = Scheduler()
+        self.dead_proxies = []
         self.plugins = []
         self.tor_process = None
+        self.tor_pool_process = None
+        self.tor_pool = []
         self.vpn_process = None
         signal.signal(signal.SIGINT, self.signal_handler)
-        self.geoip_reader = self.init_geoip()
+        self._geoip_reader = None
         self.load_plugins()
+        self.refresher = None
+        if self.config['auto_refresh']:
+            self.start_auto_refresh()
         
     # ==== INITIALIZATION METHODS ====
     def init_geoip(self):
         if os.path.exists(GEOIP_DB_PATH):
             try:
-                return geoip2.database.Reader(GEOIP_DB_PATH)
+                return require('geoip2.database').Reader(GEOIP_DB_PATH)
             except:
                 print("⚠️ Error loading GeoIP database")
                 return None
         return None
         
+    @property
+    def geoip_reader(self):
+        # Opening the GeoIP database is deferred until a lookup needs it
+        if self._geoip_reader is None:
+            self._geoip_reader = self.init_geoip() or False
+        return self._geoip_reader or None
+        
     def signal_handler(self, signum, frame):
         print("\n\033[1;31m🛑 Interrupt received! Shutting down...\033[0m")
         self.stop_rotation()
+        self.scheduler.stop()
+        self.stop_auto_refresh()
         if self.local_proxy_active:
             self.stop_local_proxy()
         self.disable_kill_switch()
         self.save_state()
         self.stop_tor()
+        self.stop_tor_pool()
         self.stop_vpn()
+        self.sessions.close_all()
+        self.health_store.close()
         sys.exit(0)
         
     def setup_directories(self):
@@ -183,6 +257,39 @@ class ShadowProxyNexus:
         os.makedirs("vpn_configs", exist_ok=True)
         os.makedirs("tor_data", exist_ok=True)
         
+    # ==== STATE PERSISTENCE ====
+    def load_json(self, path, default):
+        if not os.path.exists(path):
+            return default
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"⚠️ Error loading {path}: {str(e)}")
+            return default
+            
+    def load_config(self):
+        if os.path.exists(CONFIG_FILE):
+            self.config = {**self.config, **self.load_json(CONFIG_FILE, {})}
+        else:
+            self.save_config()
+            
+    def load_favorites(self):
+        self.favorites = OrderedDict(
+            (proxy_key(fav), fav) for fav in self.load_json('favorites.json', [])
+        )
+        
+    def load_history(self):
+        self.history = self.load_json('history.json', [])
+        
+    def save_config(self):
+        """Config, favorites and history are written on a debounce via self.state"""
+        self.state.mark('config')
+        return True
+        
+    def save_state(self):
+        return self.state.flush()
+        
     def load_plugins(self):
         if not self.config['plugin_system']:
             return
@@ -227,14 +334,14 @@ class ShadowProxyNexus:
                 torrc_config['UseBridges'] = '1'
                 torrc_config['Bridge'] = bridges[:3]  # Use first 3 bridges
                 
-            self.tor_process = stem.process.launch_tor_with_config(
+            self.tor_process = require('stem.process').launch_tor_with_config(
                 config=torrc_config,
                 init_msg_handler=lambda line: print(line) if "Bootstrapped" in line else None
             )
             print("✅ Tor network activated")
             
             # Create multiple circuits
-            with Controller.from_port(port=9051) as controller:
+            with require('stem.control').Controller.from_port(port=9051) as controller:
                 controller.authenticate()
                 for i in range(circuits):
                     controller.new_circuit()
@@ -249,6 +356,74 @@ class ShadowProxyNexus:
             self.tor_process.terminate()
             print("🧅 Tor stopped")
             
+    def start_tor_pool(self, size=None):
+        """Run one Tor with N isolated SocksPorts and balance connections across them"""
+        size = size or self.config['tor_pool_size']
+        base_port = self.config['tor_pool_base_port']
+        print(f"🧅 Starting Tor pool with {size} isolated SOCKS ports...")
+        try:
+            # Streams on different SocksPorts never share a circuit, so each port gets
+            # its own exit; IsolateSOCKSAuth lets clients split further by username.
+            # No IsolateDestAddr: one circuit per port keeps the exit tor_pool_exits reports.
+            ports = [base_port + i for i in range(size)]
+            torrc_config = {
+                'SocksPort': [f"{port} IsolateSOCKSAuth" for port in ports],
+                'DataDirectory': 'tor_data/pool',
+                'Log': 'notice stdout',
+                'CircuitBuildTimeout': '10',
+                'LearnCircuitBuildTimeout': '0',
+                'MaxCircuitDirtiness': '600',
+                'MaxClientCircuitsPending': str(max(32, size * 4))
+            }
+            os.makedirs('tor_data/pool', exist_ok=True)
+            self.tor_pool_process = require('stem.process').launch_tor_with_config(
+                config=torrc_config,
+                init_msg_handler=lambda line: print(line) if "Bootstrapped" in line else None
+            )
+            self.tor_pool = [
+                {'host': LOCAL_PROXY_HOST, 'port': port, 'protocol': 'socks5',
+                 'country': 'TOR', 'latency': 1000, 'tor': True}
+                for port in ports
+            ]
+            print(f"✅ Tor pool ready on ports {ports[0]}-{ports[-1]}")
+            return self.load_balance_proxies(self.tor_pool)
+        except Exception as e:
+            print(f"❌ Tor pool startup failed: {str(e)}")
+            self.stop_tor_pool()
+            return False
+            
+    def tor_pool_exits(self):
+        """Exit IP behind each pool port, checked in parallel"""
+        def exit_ip(upstream):
+            # socks5h resolves through Tor so DNS doesn't leak
+            try:
+                return self.exit_ips.get(f"socks5h://{upstream['host']}:{upstream['port']}", timeout=30)['ip']
+            except Exception:
+                return None
+                
+        with ThreadPoolExecutor(max_workers=max(1, len(self.tor_pool))) as executor:
+            exits = dict(zip((p['port'] for p in self.tor_pool), executor.map(exit_ip, self.tor_pool)))
+        for port, ip in exits.items():
+            print(f"🧅 :{port} → {ip or 'unreachable'}")
+        distinct = {ip for ip in exits.values() if ip}
+        print(f"🌐 {len(distinct)} distinct exit IPs across {len(exits)} ports")
+        return exits
+        
+    def stop_tor_pool(self):
+        if not self.tor_pool_process:
+            return False
+        if self.local_proxy:
+            remaining = [p for p in self.local_proxy.balancer.upstreams() if not p.get('tor')]
+            if remaining:
+                self.local_proxy.set_upstreams(remaining)
+            else:
+                self.stop_local_proxy()
+        self.tor_pool_process.terminate()
+        self.tor_pool_process = None
+        self.tor_pool = []
+        print("🧅 Tor pool stopped")
+        return True
+            
     def start_vpn(self, config_file):
         print("🔒 Starting VPN connection...")
         try:
@@ -310,7 +485,7 @@ class ShadowProxyNexus:
         print("🕵️ Spoofing browser fingerprints...")
         try:
             # Generate fake fingerprint data
-            fake = faker.Faker()
+            fake = require('faker').Faker()
             profile = {
                 'user_agent': fake.user_agent(),
                 'screen_resolution': f"{random.randint(1280, 3840)}x{random.randint(720, 2160)}",
@@ -333,7 +508,7 @@ class ShadowProxyNexus:
         """Generate randomized HTTP headers"""
         print("🔄 Randomizing HTTP headers...")
         try:
-            fake = faker.Faker()
+            fake = require('faker').Faker()
             headers = {
                 'User-Agent': fake.user_agent(),
                 'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
@@ -393,7 +568,8 @@ class ShadowProxyNexus:
         """Configure TLS version and cipher suites"""
         print(f"🔐 Setting TLS version to {version}...")
         try:
-            ctx = OpenSSL.SSL.Context(getattr(OpenSSL.SSL, f'{version}_METHOD'))
+            SSL = require('OpenSSL').SSL
+            ctx = SSL.Context(getattr(SSL, f'{version}_METHOD'))
             
             if ciphers:
                 ctx.set_cipher_list(':'.join(ciphers))
@@ -409,9 +585,10 @@ class ShadowProxyNexus:
         """Implement port knocking sequence"""
         print("🚪 Performing port knocking...")
         try:
+            scapy = require('scapy.all')
             for port in sequence:
-                packet = IP(dst=self.current_proxy['host'])/TCP(dport=port, flags="S")
-                send(packet, iface=interface, verbose=0)
+                packet = scapy.IP(dst=self.current_proxy['host'])/scapy.TCP(dport=port, flags="S")
+                scapy.send(packet, iface=interface, verbose=0)
                 time.sleep(0.5)
             print("✅ Port knocking sequence completed")
             return True
@@ -441,13 +618,11 @@ class ShadowProxyNexus:
         print("📊 Starting real-time traffic monitor...")
         try:
             def monitor():
-                while True:
-                    sent = self.traffic_stats['sent'] / (1024 * 1024)
-                    recv = self.traffic_stats['received'] / (1024 * 1024)
-                    print(f"\r⬆️ {sent:.2f} MB | ⬇️ {recv:.2f} MB | 📊 {sent+recv:.2f} MB", end="")
-                    time.sleep(1)
-                    
-            threading.Thread(target=monitor, daemon=True).start()
+                sent = self.traffic_stats['sent'] / (1024 * 1024)
+                recv = self.traffic_stats['received'] / (1024 * 1024)
+                print(f"\r⬆️ {sent:.2f} MB | ⬇️ {recv:.2f} MB | 📊 {sent+recv:.2f} MB", end="")
+                
+            self.scheduler.every(1, monitor, name='traffic_monitor', first_run=0, catch_up='delay')
             print("✅ Traffic monitor active")
             return True
         except Exception as e:
@@ -459,17 +634,34 @@ class ShadowProxyNexus:
         print("🔁 Enabling auto-reconnect...")
         self.config['auto_reconnect'] = True
         
-        def reconnect_monitor():
-            while self.config['auto_reconnect']:
-                if not self.test_proxy(self.current_proxy):
-                    print("⚠️ Connection lost! Reconnecting...")
-                    self.rotate_proxy()
-                time.sleep(30)
-                
-        threading.Thread(target=reconnect_monitor, daemon=True).start()
+        # A standby queue turns each reconnect into a pop instead of a scan
+        self.start_auto_refresh()
+        
+        failures = [0]
+        
+        def reconnect_check():
+            if not self.config['auto_reconnect']:
+                self.scheduler.cancel('reconnect')
+                return None
+            if self.test_proxy(self.current_proxy, max_age=0)['working']:
+                failures[0] = 0
+                return None
+            print("⚠️ Connection lost! Reconnecting...")
+            if self.rotate_proxy():
+                failures[0] = 0
+                return None
+            # Nothing answered; wait longer each time instead of rescanning every 30s
+            failures[0] += 1
+            return backoff_delay(failures[0] - 1, 30, 600)
+            
+        self.scheduler.every(30, reconnect_check, name='reconnect', catch_up='delay')
         print("✅ Auto-reconnect enabled")
         return True
         
+    def stop_auto_reconnect(self):
+        self.config['auto_reconnect'] = False
+        return self.scheduler.cancel('reconnect')
+        
     def proxy_health_dashboard(self):
         """Display comprehensive proxy health dashboard"""
         print("\n\033[1;35m" + "="*80)
@@ -480,22 +672,26 @@ class ShadowProxyNexus:
             print("⚠️ No active proxy")
             return
             
-        # Connection status
-        status = "🟢 ONLINE" if self.test_proxy(self.current_proxy) else "🔴 OFFLINE"
-        print(f"🔌 Connection Status: {status}")
-        
-        # Speed test
-        speed = self.speed_test()
-        print(f"⚡ Speed: {speed:.2f} KB/s")
-        
-        # Anonymity test
-        anonymity = self.test_proxy_anonymity()
-        print(f"🎭 Anonymity: {anonymity}")
-        
-        # IP information
-        ip_info = self.get_ip_info()
-        print(f"🌍 IP: {ip_info.get('ip', 'N/A')}")
-        print(f"📍 Location: {ip_info.get('city', 'N/A')}, {ip_info.get('country', 'N/A')}")
+        # Run the checks side by side; status and IP info share one exit-IP lookup
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            status = executor.submit(self.test_proxy, self.current_proxy, max_age=0)
+            speed = executor.submit(self.speed_test)
+            anonymity = executor.submit(self.test_proxy_anonymity)
+            ip_info = executor.submit(self.get_ip_info)
+            
+            # Connection status
+            print(f"🔌 Connection Status: {'🟢 ONLINE' if status.result()['working'] else '🔴 OFFLINE'}")
+            
+            # Speed test
+            print(f"⚡ Speed: {speed.result() or 0:.2f} KB/s")
+            
+            # Anonymity test
+            print(f"🎭 Anonymity: {anonymity.result()}")
+            
+            # IP information
+            info = ip_info.result()
+            print(f"🌍 IP: {info.get('ip', 'N/A')}")
+            print(f"📍 Location: {info.get('city', 'N/A')}, {info.get('country', 'N/A')}")
         
         # Traffic stats
         print(f"📦 Data Sent: {self.traffic_stats['sent'] / (1024*1024):.2f} MB")
@@ -504,47 +700,87 @@ class ShadowProxyNexus:
         print("="*80)
         return True
         
+    def speed_test(self, proxy=None, test_url="http://example.com", timeout=5):
+        """Download speed through the proxy in KB/s, or None on failure"""
+        target = proxy or self.current_proxy
+        try:
+            start = time.time()
+            response = self.sessions.for_proxy(target).get(test_url, timeout=timeout)
+            response.raise_for_status()
+            self.traffic_stats['received'] += len(response.content)
+            return len(response.content) / (time.time() - start) / 1024
+        except Exception:
+            return None
+            
+    def test_proxy_anonymity(self, proxy=None):
+        """Classify the proxy as Elite, Anonymous or Transparent from the headers it adds"""
+        target = proxy or self.current_proxy
+        try:
+            real_ip = self.exit_ips.get(None)['ip']
+            response = self.sessions.for_proxy(target).get("http://httpbin.org/headers", timeout=10)
+            headers = {k.lower(): v for k, v in response.json()['headers'].items()}
+            if any(real_ip in value for value in headers.values()):
+                return "Transparent"
+            if {'via', 'x-forwarded-for', 'forwarded', 'x-real-ip'} & headers.keys():
+                return "Anonymous"
+            return "Elite"
+        except Exception:
+            return "Unknown"
+            
+    def get_ip_info(self, proxy=None):
+        """Exit IP (from the shared cache) with its city and country"""
+        target = proxy or self.current_proxy
+        try:
+            ip = self.exit_ips.get(target)['ip']
+        except Exception:
+            return {}
+        try:
+            data = self.sessions.direct().get(f"http://ip-api.com/json/{ip}", timeout=10).json()
+            return {'ip': ip, 'city': data.get('city', 'N/A'), 'country': data.get('country', 'N/A')}
+        except Exception:
+            return {'ip': ip}
+            
     def schedule_rotation(self, interval="hourly"):
-        """Schedule proxy rotation"""
+        """Schedule proxy rotation: hourly, daily, weekly, daily@HH:MM or an interval like 30m"""
         print(f"⏰ Scheduling proxy rotation: {interval}")
+        
+        def rotate():
+            print("\n🔄 Scheduled rotation triggered")
+            self.rotate_proxy()
+            
+        try:
+            job = self.scheduler.every(interval, rotate, name='rotation')
+        except ValueError as e:
+            print(f"⚠️ {str(e)}")
+            return False
         self.config['scheduled_rotation'] = interval
+        self.rotation_active = True
+        print(f"✅ Rotation scheduled, first at {datetime.fromtimestamp(job.next_run).strftime('%Y-%m-%d %H:%M')}")
+        return True
         
-        def scheduler():
-            while True:
-                if interval == "hourly":
-                    sleep_time = 3600
-                elif interval == "daily":
-                    sleep_time = 86400
-                elif interval == "weekly":
-                    sleep_time = 604800
-                else:
-                    sleep_time = 1800  # 30 minutes default
-                    
-                time.sleep(sleep_time)
-                print("\n🔄 Scheduled rotation triggered")
-                self.rotate_proxy()
-                
-        threading.Thread(target=scheduler, daemon=True).start()
-        print("✅ Rotation scheduled")
+    def stop_rotation(self):
+        """Cancel scheduled rotation"""
+        if not self.rotation_active:
+            return False
+        self.rotation_active = False
+        self.config['scheduled_rotation'] = None
+        self.scheduler.cancel('rotation')
+        print("⏹ Scheduled rotation stopped")
         return True
         
     def select_ip_by_location(self, country=None, city=None):
         """Select proxy by geographic location"""
         print(f"🗺 Selecting proxy by location - Country: {country}, City: {city}")
-        candidates = []
-        
-        for proxy in self.proxies:
-            if country and proxy.get('country') != country:
-                continue
-            if city and proxy.get('city') != city:
-                continue
-            candidates.append(proxy)
-            
-        if not candidates:
+        # Index lookup, then two random draws; no pass over the whole pool
+        candidates = self.proxies.select(country=country, city=city)
+        if self.blacklist:
+            candidates = [p for p in candidates if proxy_key(p) not in self.blacklist]
+        # pick skips proxies whose breaker is open; a location match still beats nothing
+        selected = self.selector.pick(candidates) or (random.choice(candidates) if candidates else None)
+        if not selected:
             print("⚠️ No proxies found in specified location")
             return False
             
-        selected = random.choice(candidates)
         self.set_proxy(selected)
         print(f"✅ Selected proxy: {selected['host']}:{selected['port']} in {selected.get('city', 'N/A')}, {selected.get('country', 'N/A')}")
         return True
@@ -589,48 +825,253 @@ class ShadowProxyNexus:
             return False
             
     # ==== PERFORMANCE OPTIMIZATION ====
-    def concurrent_proxy_test(self):
-        """Test all proxies concurrently"""
+    def concurrent_proxy_test(self, on_result=None, workers=None):
+        """Test all proxies concurrently with a bounded number of open sockets"""
         print("🧪 Testing proxies concurrently...")
         try:
-            test_results = []
-            threads = []
+            total = len(self.proxies)
+            progress = {'done': 0, 'working': 0}
+            working = []
+            dead = []
+            outcomes = []
             
-            def test_proxy_thread(proxy):
-                result = self.test_proxy(proxy)
-                test_results.append((proxy, result))
-                
-            for proxy in self.proxies:
-                t = threading.Thread(target=test_proxy_thread, args=(proxy,))
-                t.start()
-                threads.append(t)
-                
-            for t in threads:
-                t.join()
+            def record(proxy, result):
+                # Runs on the validator's event loop, one result at a time
+                progress['done'] += 1
+                outcomes.append((proxy, result))
+                self.selector.record(proxy, result)
+                self.check_blacklist(proxy)
+                proxy['last_checked'] = datetime.now().isoformat()
+                if result['working']:
+                    self.proxies.reindex(proxy)
+                    progress['working'] += 1
+                    self.traffic_stats['received'] += result['bytes']
+                    self.exit_ips.put(proxy, result['ip'], latency=result['latency'])
+                    working.append(proxy)
+                else:
+                    dead.append(proxy)
+                print(f"\r🔎 Tested {progress['done']}/{total} | ✅ {progress['working']} working", end="")
+                if on_result:
+                    on_result(proxy, result)
+                    
+            validator = AsyncProxyValidator(
+                endpoints=self.ip_echo,
+                max_in_flight=workers or self.config['validator_concurrency'],
+                timeout=self.config['validator_timeout'],
+                breaker=self.selector.breaker
+            )
+            candidates = [p for p in self.proxies if proxy_key(p) not in self.blacklist]
+            cooling = [p for p in candidates if not self.selector.breaker.available(p)]
+            if cooling:
+                total -= len(cooling)
+                print(f"⏸ Skipping {len(cooling)} proxies that failed recently")
+            validator.validate_sync(candidates, want=None, on_result=record)
+            print()
+            self.health_store.record_results(outcomes)
                 
-            # Update proxy list with results
-            self.proxies = [proxy for proxy, result in test_results if result]
-            print(f"✅ {len(self.proxies)} working proxies identified")
-            return True
+            # Keep measured results, plus cooling proxies whose breaker will retry them later
+            self.proxies = ProxyPool(sorted(working, key=lambda p: p['latency']) + cooling)
+            self.dead_proxies = dead
+            print(f"✅ {len(working)} working / ❌ {len(dead)} dead proxies identified")
+            return {'working': working, 'dead': dead}
         except Exception as e:
             print(f"❌ Concurrent testing failed: {str(e)}")
             return False
             
+    def find_working_proxies(self, count=1, verbose=True, exclude=(), candidates=None):
+        """Validate the pool (or just `candidates`) concurrently and return the first `count` that answer"""
+        if candidates is None:
+            candidates = self.selector.order(
+                p for p in self.proxies
+                if proxy_key(p) not in exclude and proxy_key(p) not in self.blacklist
+            )
+        else:
+            # Standby entries are validator copies; record outcomes on the pool's own records
+            candidates = [self.proxies.get(proxy_key(p)) or p for p in candidates]
+        validator = AsyncProxyValidator(
+            endpoints=self.ip_echo,
+            max_in_flight=self.config['validator_concurrency'],
+            timeout=self.config['validator_timeout'],
+            breaker=self.selector.breaker
+        )
+        outcomes = []
+        
+        def record(proxy, result):
+            outcomes.append((proxy, result))
+            self.selector.record(proxy, result)
+            self.check_blacklist(proxy)
+            if result['working']:
+                self.proxies.reindex(proxy)
+                self.exit_ips.put(proxy, result['ip'], latency=result['latency'])
+            
+        working = validator.validate_sync(candidates, want=count, on_result=record)
+        self.health_store.record_results(outcomes)
+        for proxy in working:
+            self.traffic_stats['received'] += proxy.pop('bytes', 0)
+        if verbose:
+            print(f"✅ {len(working)} working proxies found" if working else "❌ No working proxies found")
+        return working
+        
+    def blacklist_proxy(self, proxy, reason="manual"):
+        """Exclude a proxy from selection, validation and imports"""
+        key = proxy_key(proxy)
+        if key in self.blacklist:
+            return False
+        self.blacklist.add(key)
+        self.sessions.discard(proxy)
+        if self.local_proxy:
+            self.local_proxy.mark_dead(proxy)
+        print(f"🚫 Blacklisted {proxy['host']}:{proxy['port']} ({reason})")
+        return True
+        
+    def unblacklist_proxy(self, proxy):
+        key = proxy_key(proxy)
+        if key not in self.blacklist:
+            return False
+        self.blacklist.discard(key)
+        proxy.pop('fail_streak', None)
+        proxy.pop('open_until', None)
+        return True
+        
+    def check_blacklist(self, proxy):
+        """Blacklist a proxy once its breaker has reopened blacklist_after times in a row"""
+        if proxy.get('fail_streak', 0) >= self.config['blacklist_after']:
+            self.blacklist_proxy(proxy, f"{proxy['fail_streak']} failures in a row")
+            
+    def refresh_sources(self):
+        """Re-import every configured custom proxy source"""
+        for source in self.config['custom_proxy_sources']:
+            self.import_custom_proxies(source, verbose=False)
+        return True
+        
+    def start_auto_refresh(self):
+        """Refetch and revalidate in the background every refresh_interval minutes"""
+        if self.refresher:
+            return False
+        self.refresher = PoolRefresher(
+            fetch=self.refresh_sources,
+            validate=lambda count, exclude, candidates=None: self.find_working_proxies(
+                count, verbose=False, exclude=exclude, candidates=candidates),
+            interval_min=self.config['refresh_interval'],
+            standby_size=self.config['warm_pool_size'],
+            standby_ttl=self.config['standby_ttl']
+        )
+        self.refresher.start()
+        print(f"♻️ Auto-refresh every {self.config['refresh_interval']} min")
+        return True
+        
+    def stop_auto_refresh(self):
+        if not self.refresher:
+            return False
+        self.refresher.stop()
+        self.refresher = None
+        return True
+        
+    def check_exit_ip(self, proxy, timeout=None):
+        """Address the IP echo service sees, through proxy or directly when proxy is None"""
+        session = self.sessions.direct() if proxy is None else self.sessions.for_proxy(proxy)
+        
+        def ask(url):
+            response = session.get(url, timeout=timeout or self.config['validator_timeout'])
+            self.traffic_stats['received'] += len(response.content)
+            return parse_echo_ip(response.status_code, response.text)
+            
+        start = time.time()
+        ip = self.ip_echo.first(ask)
+        return {'ip': ip, 'latency': int((time.time() - start) * 1000)}
+        
+    def test_proxy(self, proxy, max_age=0):
+        """Check a single proxy; live by default, since callers use it to decide liveness"""
+        if not proxy:
+            return {'working': False}
+        try:
+            result = self.exit_ips.get(proxy, max_age)
+            self.selector.breaker.record(self.proxies.get(proxy_key(proxy)) or proxy, True)
+            return {'working': True, 'ip': result['ip'], 'latency': result['latency']}
+        except Exception:
+            pass
+        self.exit_ips.invalidate(proxy)
+        record = self.proxies.get(proxy_key(proxy)) or proxy
+        self.selector.breaker.record(record, False)
+        self.check_blacklist(record)
+        self.sessions.discard(proxy)
+        if self.refresher:
+            self.refresher.discard(proxy)
+        if self.local_proxy:
+            self.local_proxy.mark_dead(proxy)
+        return {'working': False}
+        
+    def set_proxy(self, proxy):
+        """Point this process and its children at the given proxy"""
+        proxy_url = f"{proxy['protocol']}://{proxy['host']}:{proxy['port']}"
+        self.current_proxy = proxy
+        self.selector.mark_used(proxy)
+        os.environ['HTTP_PROXY'] = proxy_url
+        os.environ['HTTPS_PROXY'] = proxy_url
+        return True
+        
+    def rotate_proxy(self):
+        """Switch to a standby proxy, validating on demand only if the queue is empty"""
+        proxy = self.refresher.pop() if self.refresher else None
+        if not proxy:
+            working = self.find_working_proxies(1, verbose=False)
+            proxy = working[0] if working else None
+        if not proxy:
+            print("❌ No working proxy available")
+            return False
+        self.set_proxy(proxy)
+        print(f"🔄 Rotated to {proxy['host']}:{proxy['port']} ({proxy.get('latency', '?')}ms)")
+        return True
+            
+    def start_local_proxy(self):
+        """Serve a fixed local endpoint that forwards through the balanced upstreams"""
+        if self.local_proxy_active:
+            return True
+        try:
+            self.local_proxy = LocalForwarder(
+                LOCAL_PROXY_HOST, LOCAL_PROXY_PORT,
+                balance=self.config['balance_strategy'],
+                sticky=self.config['balance_sticky'],
+                max_failures=self.config['balance_max_failures'],
+                quarantine=self.config['balance_quarantine']
+            )
+            self.local_proxy.set_upstream(self.current_proxy)
+            self.local_proxy.start()
+            self.local_proxy_thread = self.local_proxy.thread
+            self.local_proxy_active = True
+            print(f"✅ Local proxy running at {LOCAL_PROXY_HOST}:{LOCAL_PROXY_PORT}")
+            return True
+        except Exception as e:
+            self.local_proxy = None
+            print(f"❌ Failed to start local proxy: {str(e)}")
+            return False
+            
+    def stop_local_proxy(self):
+        if not self.local_proxy_active:
+            return False
+        self.local_proxy.stop()
+        self.local_proxy = None
+        self.local_proxy_thread = None
+        self.local_proxy_active = False
+        self.config['proxy_load_balancing'] = False
+        return True
+        
     def load_balance_proxies(self, proxies):
-        """Distribute traffic across multiple proxies"""
+        """Distribute client connections across multiple proxies via the local forwarder"""
         print("⚖️ Enabling proxy load balancing...")
         try:
+            if not proxies:
+                print("⚠️ No proxies to balance across")
+                return False
+            if not self.start_local_proxy():
+                return False
+            self.local_proxy.set_upstreams(proxies)
             self.config['proxy_load_balancing'] = True
-            self.config['load_balance_pool'] = proxies
-            
-            def balancer():
-                while self.config['proxy_load_balancing']:
-                    # Rotate through proxy pool
-                    self.current_proxy = random.choice(proxies)
-                    time.sleep(10)  # Rotate every 10 seconds
-                    
-            threading.Thread(target=balancer, daemon=True).start()
-            print(f"✅ Load balancing across {len(proxies)} proxies")
+            proxy_url = f"http://{LOCAL_PROXY_HOST}:{LOCAL_PROXY_PORT}"
+            os.environ['HTTP_PROXY'] = proxy_url
+            os.environ['HTTPS_PROXY'] = proxy_url
+            print(f"✅ Load balancing across {len(proxies)} proxies "
+                  f"({self.config['balance_strategy']}, sticky: {self.config['balance_sticky']})")
             return True
         except Exception as e:
             print(f"❌ Load balancing failed: {str(e)}")
@@ -710,7 +1151,7 @@ class ShadowProxyNexus:
                 f.write(f"{self.current_proxy['protocol']} {self.current_proxy['host']} {self.current_proxy['port']}\n")
                 
             # Run scan
-            nm = nmap.PortScanner()
+            nm = require('nmap').PortScanner()
             nm.scan(target, arguments='-sS -T4 -Pn', proxychains=True)
             
             print(f"✅ Scan results for {target}:")
@@ -756,32 +1197,32 @@ class ShadowProxyNexus:
         self.config['detailed_logging'] = True
         
         def log_traffic():
-            while self.config['detailed_logging']:
-                # This would interface with system traffic monitoring
-                # For demonstration, we'll just log to file
-                with open('traffic.log', 'a') as f:
-                    f.write(f"{datetime.now()}: Sent {self.traffic_stats['sent']}, Received {self.traffic_stats['received']}\n")
-                time.sleep(60)
+            if not self.config['detailed_logging']:
+                self.scheduler.cancel('traffic_log')
+                return
+            # This would interface with system traffic monitoring
+            # For demonstration, we'll just log to file
+            with open('traffic.log', 'a') as f:
+                f.write(f"{datetime.now()}: Sent {self.traffic_stats['sent']}, Received {self.traffic_stats['received']}\n")
                 
-        threading.Thread(target=log_traffic, daemon=True).start()
+        self.scheduler.every(60, log_traffic, name='traffic_log', first_run=0)
         print("✅ Traffic logging active")
         return True
         
     def ip_leak_test(self):
         """Test for IP leaks"""
         print("🔍 Testing for IP leaks...")
+        if not self.current_proxy:
+            # Both lookups would be the direct connection and always "leak"
+            print("⚠️ No active proxy")
+            return False
         try:
-            # Test without proxy
-            real_ip = requests.get(IP_CHECK_URL).text.strip()
-            
-            # Test with proxy
-            proxy_url = f"{self.current_proxy['protocol']}://{self.current_proxy['host']}:{self.current_proxy['port']}"
-            session = requests.Session()
-            session.proxies = {
-                'http': proxy_url,
-                'https': proxy_url
-            }
-            proxy_ip = session.get(IP_CHECK_URL).text.strip()
+            # Test without and with the proxy at the same time; recent checks are reused
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                real = executor.submit(self.exit_ips.get, None, timeout=10)
+                via_proxy = executor.submit(self.exit_ips.get, self.current_proxy, timeout=10)
+                real_ip = real.result()['ip']
+                proxy_ip = via_proxy.result()['ip']
             
             # Compare results
             if real_ip == proxy_ip:
@@ -805,7 +1246,7 @@ class ShadowProxyNexus:
                 'sent': self.traffic_stats['sent'] / (1024 * 1024),
                 'received': self.traffic_stats['received'] / (1024 * 1024),
                 'total': (self.traffic_stats['sent'] + self.traffic_stats['received']) / (1024 * 1024),
-                'top_proxies': sorted(self.proxies, key=lambda p: p.get('data_used', 0), reverse=True)[:3]
+                'top_proxies': [dict(p) for p in sorted(self.proxies, key=lambda p: p.get('data_used', 0), reverse=True)[:3]]
             }
             
             filename = f"reports/{period}_report_{int(time.time())}.json"
@@ -819,24 +1260,31 @@ class ShadowProxyNexus:
             return False
             
     # ==== CUSTOMIZATION ====
-    def import_custom_proxies(self, source):
+    def import_custom_proxies(self, source, verbose=True):
         """Import proxies from custom source"""
-        print(f"📥 Importing proxies from {source}...")
+        if verbose:
+            print(f"📥 Importing proxies from {source}...")
         try:
             if source.startswith('http'):
                 # From URL
-                response = requests.get(source)
+                response = self.sessions.direct().get(source, timeout=30)
                 proxies = response.json()
             else:
                 # From file
                 with open(source, 'r') as f:
                     proxies = json.load(f)
                     
-            self.proxies.extend(proxies)
-            print(f"✅ Added {len(proxies)} custom proxies")
+            for entry in proxies:
+                entry.setdefault('protocol', 'http')
+            proxies = [entry for entry in proxies if proxy_key(entry) not in self.blacklist]
+            added, updated = self.proxies.merge(proxies)
+            self.health_store.upsert_seen(proxies)
+            if verbose:
+                print(f"✅ Added {added} custom proxies ({updated} already known)")
             return True
         except Exception as e:
-            print(f"❌ Import failed: {str(e)}")
+            if verbose:
+                print(f"❌ Import failed: {str(e)}")
             return False
             
     def regex_proxy_filter(self, pattern):
@@ -844,7 +1292,16 @@ class ShadowProxyNexus:
         print(f"🔍 Filtering proxies with pattern: {pattern}")
         try:
             regex = re.compile(pattern, re.IGNORECASE)
-            filtered = [p for p in self.proxies if regex.search(p['host']) or regex.search(p.get('country', ''))]
+            # Countries are matched once per distinct value; hosts only need the pool's keys
+            filtered = [
+                p for country in self.proxies.values('country') if regex.search(country)
+                for p in self.proxies.select(country=country)
+            ]
+            seen = {proxy_key(p) for p in filtered}
+            filtered += [
+                self.proxies.get(key) for key in list(self.proxies.positions)
+                if key not in seen and regex.search(key[0])
+            ]
             print(f"✅ Found {len(filtered)} matching proxies")
             return filtered
         except Exception as e:
@@ -901,9 +1358,12 @@ class ShadowProxyNexus:
             return False
 
 # ===== MENU SYSTEM =====
-def main_menu():
+def main_menu(report_startup=False):
+    imports_done = time.perf_counter()
     display_banner()
     proxy = ShadowProxyNexus()
+    if report_startup:
+        startup_report(imports_done, time.perf_counter())
     
     while True:
         print("\n\033[1;34m" + "="*80)
@@ -937,6 +1397,9 @@ def main_menu():
         else:
             print("⚠️ Invalid selection")
 
+    # Config, favorites and history are written on a debounce; don't lose the last window
+    proxy.save_state()
+
 # ===== SUBMENUS =====
 def proxy_management_menu(proxy):
     # ... (Similar structure to previous implementation) ...
@@ -954,7 +1417,8 @@ def anonymity_menu(proxy):
         print("5. 🛡️ WebRTC Leak Prevention")
         print("6. 🖼️ Fingerprint Spoofing")
         print("7. 📝 HTTP Header Randomization")
-        print("8. 🔙 Back")
+        print("8. 🧅 Tor Pool (parallel exits)")
+        print("9. 🔙 Back")
         
         choice = input("\n🔍 Select option: ").strip()
         
@@ -977,6 +1441,15 @@ def anonymity_menu(proxy):
         elif choice == '7':
             proxy.randomize_http_headers()
         elif choice == '8':
+            if proxy.tor_pool_process:
+                proxy.tor_pool_exits()
+                if input("Stop Tor pool? (y/n): ").lower() == 'y':
+                    proxy.stop_tor_pool()
+            else:
+                size = input(f"Number of exits [{proxy.config['tor_pool_size']}]: ") or proxy.config['tor_pool_size']
+                if proxy.start_tor_pool(int(size)):
+                    proxy.tor_pool_exits()
+        elif choice == '9':
             break
         else:
             print("⚠️ Invalid selection")
@@ -1039,7 +1512,7 @@ def performance_menu(proxy):
             proxy.concurrent_proxy_test()
         elif choice == '2':
             count = input("Number of proxies [3]: ") or "3"
-            proxies = random.sample(proxy.proxies, min(int(count), len(proxy.proxies)))
+            proxies = proxy.find_working_proxies(int(count))
             proxy.load_balance_proxies(proxies)
         elif choice == '3':
             down = input("Download speed (Kbps) [1024]: ") or "1024"
@@ -1068,4 +1541,4 @@ if __name__ == "__main__":
         print("\033[1;31m⚠️ Root privileges required! Run with sudo.\033[0m")
         sys.exit(1)
         
-    main_menu()
\ No newline at end of file
+    main_menu(report_startup='--startup-report' in sys.argv)
\ No newline at end of file